@@ -87,9 +87,17 @@ function preloadImages() {
 \*---------------------------------------------------------------------------*/
 
 function openSocket() {
+    // Only open a channel if this page renders any of our stats (which are
+    // the only thing that we broadcast).
+    var topic = $('.num_users, .num_active_users, .num_messages, .messages_per_minute').length ? 'stats' : null;
+    if (!topic) {
+        return;
+    }
+
     $.ajax({
         type: 'GET',
         url: '/token',
+        data: {topic: topic},
         cache: false,
         beforeSend: function(jqXHR, settings) {
             if (socket) {
@@ -245,6 +253,7 @@ function init() {
         flipclocks.filter('.num_users').flipclock('init', {digits: 4});
         flipclocks.filter('.num_active_users').flipclock('init', {digits: 4});
         flipclocks.filter('.num_messages').flipclock('init', {digits: 4});
+        flipclocks.filter('.messages_per_minute').flipclock('init', {digits: 4});
     }
 
     if ($('#gravatars').length) {
@@ -367,9 +376,55 @@ function signUp() {
  |                                parseJSON()                                |
 \*---------------------------------------------------------------------------*/
 
+var statsSeq = null;
+
 function parseJSON(json) {
+    // Each stats message carries a sequence number and either a full snapshot
+    // of the stats or only the stats that changed since the last message.  If
+    // we've missed a message, then resync with a full snapshot.
     var obj = $.parseJSON(json);
-    $.each(obj, function(key, val) {
+    if (obj.full || statsSeq === null || obj.seq === statsSeq + 1) {
+        statsSeq = obj.seq;
+        showStats(obj.stats);
+    } else if (obj.seq > statsSeq) {
+        resyncStats();
+    }
+}
+
+
+/*---------------------------------------------------------------------------*\
+ |                               resyncStats()                               |
+\*---------------------------------------------------------------------------*/
+
+var resyncStatsRequest = null;
+
+function resyncStats() {
+    if (resyncStatsRequest) {
+        return;
+    }
+
+    resyncStatsRequest = $.ajax({
+        type: 'GET',
+        url: '/stats',
+        dataType: 'json',
+        cache: false,
+        success: function(data, textStatus, jqXHR) {
+            statsSeq = data.seq;
+            showStats(data.stats);
+        },
+        complete: function(jqXHR, textStatus) {
+            resyncStatsRequest = null;
+        }
+    });
+}
+
+
+/*---------------------------------------------------------------------------*\
+ |                                showStats()                                |
+\*---------------------------------------------------------------------------*/
+
+function showStats(stats) {
+    $.each(stats, function(key, val) {
         var flipclocks = $('.flipclock.' + key);
         if (flipclocks.length) {
             flipclocks.flipclock('set', val);
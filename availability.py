@@ -27,6 +27,7 @@ import logging
 from google.appengine.ext import db
 
 import base
+import models
 
 
 _log = logging.getLogger(__name__)
@@ -57,6 +58,7 @@ class AvailabilityHandler(base.WebHandler):
         if change:
             alice.available = available
             db.put(alice)
+            models.Account.count_active(1 if available else -1)
         return alice, change
 
     def _log_available(self, available, alice, changed):
@@ -23,8 +23,10 @@
 
 
 import functools
+import hashlib
 import logging
 import os
+import time
 import traceback
 
 from django.utils import simplejson
@@ -39,17 +41,33 @@ from google.appengine.runtime import DeadlineExceededError
 from google.appengine.runtime.apiproxy_errors import CapabilityDisabledError
 
 from config import DEBUG, HTTP_CODE_TO_TITLE, TEMPLATES
-from config import NUM_USERS_KEY, NUM_ACTIVE_USERS_KEY, NUM_MESSAGES_KEY, ACTIVE_USERS_KEY
+from config import NUM_USERS_KEY, NUM_ACTIVE_USERS_KEY, NUM_MESSAGES_KEY
+from config import MESSAGES_PER_MINUTE_KEY
 from config import ADMIN_EMAILS
+from config import MEMOIZE_LOCK_SECS, MEMOIZE_VERSION_PREFIX
+from config import STATS_LRU_TTL, MEMOIZE_LRU_SIZE, MEMOIZE_LRU_TTL
+from config import NUM_RETRIES
+from config import STATS_BROADCAST_KEY, STATS_SNAPSHOT_KEY
+from config import STATS_BROADCAST_WINDOW, STATS_BROADCAST_MAX_STALENESS
+from config import STATS_FULL_SNAPSHOT_EVERY, STATS_TOPIC
+from config import PRESENCE_KEY, PRESENCE_WINDOW, PRESENCE_CHUNK_SIZE
+from config import ACTIVE_USERS_BUCKETS, PRESENCE_WORKERS
 import channels
+import coalescing
+import lru
 import models
 import notifications
+import registry
 import shards
 
 
 _log = logging.getLogger(__name__)
 
 
+_stats_cache = lru.LRUCache('stats', 1, STATS_LRU_TTL)
+_memoize_cache = lru.LRUCache('memoize', MEMOIZE_LRU_SIZE, MEMOIZE_LRU_TTL)
+
+
 class BaseHandler(object):
     """Abstract base request handler class.
     
@@ -70,7 +88,7 @@ class BaseHandler(object):
         return wrap
 
     @classmethod
-    def memoize(cls, cache_secs):
+    def memoize(cls, cache_secs, stale_secs=None, background=False):
         """Decorate a method with the memcache pattern.
 
         Technically, this memoize function isn't a decorator.  It's a function
@@ -89,38 +107,204 @@ class BaseHandler(object):
         calls will hit the cache), then return the results.  For more
         information on memoization, see:
             http://en.wikipedia.org/wiki/Memoization
+
+        Cached results are fresh for cache_secs seconds, but we keep them in
+        memcache for another stale_secs seconds (by default, another
+        cache_secs seconds).  Once the results go stale, the first caller to
+        take a short lock recomputes them (or if background, defers
+        recomputing them), and every other caller keeps getting the stale
+        results in the meantime.  So when results expire, only one caller
+        pays to recompute them.
         """
+        if stale_secs is None:
+            stale_secs = cache_secs
+
         def wrap1(method):
             @functools.wraps(method)
             def wrap2(self, *args, **kwds):
-                key = cls._compute_memcache_key(self, method, *args, **kwds)
+                key = cls._compute_memcache_key(self, method, args, kwds)
                 _log.debug('trying to retrieve cached results for %s' % key)
-                results = memcache.get(key)
-                if results is None:
-                    _log.info("couldn't retrieve cached results for %s" % key)
-                    _log.info('caching results for %s' % key)
-                    results = method(self, *args, **kwds)
-                    try:
-                        success = memcache.set(key, results, time=cache_secs)
-                    except MemoryError:
-                        success = False
-                    if not success:
-                        _log.error("couldn't cache results for %s" % key)
-                    else:
-                        _log.info('cached results for %s' % key)
+                cached = _memoize_cache.get(key)
+                if cached is not None:
+                    _log.debug('retrieved locally cached results for %s' % key)
+                    return cached[0]
+                cached = memcache.get(key)
+                if isinstance(cached, tuple):
+                    results, fresh_until = cached
+                    if time.time() < fresh_until:
+                        _log.info('retrieved cached results for %s' % key)
+                        ttl = min(MEMOIZE_LRU_TTL, fresh_until - time.time())
+                        _memoize_cache.set(key, cached, ttl=ttl)
+                        return results
+                    if not memcache.add(key + '_lock', True,
+                                        time=MEMOIZE_LOCK_SECS):
+                        _log.info('retrieved stale results for %s' % key)
+                        return results
+                    if background:
+                        _log.info('deferring recaching results for %s' % key)
+                        deferred.defer(cls._recache, type(self),
+                                       method.func_name, args, kwds,
+                                       cache_secs, stale_secs)
+                        return results
+                    locked = True
                 else:
-                    _log.info('retrieved cached results for %s' % key)
-                return results
+                    # There are no results, stale or otherwise, to fall back
+                    # to, so we have to compute them, lock or no lock.
+                    _log.info("couldn't retrieve cached results for %s" % key)
+                    locked = memcache.add(key + '_lock', True,
+                                          time=MEMOIZE_LOCK_SECS)
+                return cls._cache(key, method, self, args, kwds, cache_secs,
+                                  stale_secs, locked=locked)
+            wrap2.uncached = method
+            wrap2.invalidate = lambda: cls.invalidate_memoized(method)
             return wrap2
         return wrap1
 
     @staticmethod
-    def _compute_memcache_key(self, method, *args, **kwds):
+    def _cache(key, method, self, args, kwds, cache_secs, stale_secs,
+               locked=True):
+        """Call a memoized method, and cache (and return) its results.
+
+        If locked, then release the lock once we're done.
+        """
+        _log.info('caching results for %s' % key)
+        try:
+            results = method(self, *args, **kwds)
+            cached = (results, time.time() + cache_secs)
+            try:
+                success = memcache.set(key, cached,
+                                       time=cache_secs + stale_secs)
+            except MemoryError:
+                success = False
+            if not success:
+                _log.error("couldn't cache results for %s" % key)
+            else:
+                _log.info('cached results for %s' % key)
+            _memoize_cache.set(key, cached, ttl=min(MEMOIZE_LRU_TTL,
+                                                    cache_secs))
+        finally:
+            if locked:
+                memcache.delete(key + '_lock')
+        return results
+
+    @classmethod
+    def _recache(cls, handler_class, method_name, args, kwds, cache_secs,
+                 stale_secs):
+        """Recompute and recache a memoized method's results (in a deferred
+        task).
+        """
+        self = handler_class()
+        method = getattr(handler_class, method_name).uncached
+        key = cls._compute_memcache_key(self, method, args, kwds)
+        cls._cache(key, method, self, args, kwds, cache_secs, stale_secs)
+
+    @classmethod
+    def invalidate_memoized(cls, method):
+        """Invalidate every cached result of a memoized method, in O(1).
+
+        Every memoized method has a version, which is part of all of its
+        memcache keys.  Bump the version, so that we never look up any of the
+        old keys again.  (Other instances might keep using their locally
+        cached versions for up to MEMOIZE_LRU_TTL seconds.)
+        """
+        method = getattr(method, 'uncached', method)
+        namespace = cls._memoize_namespace(method)
+        memcache.incr(MEMOIZE_VERSION_PREFIX + namespace,
+                      initial_value=cls._seed_memoize_version())
+        _memoize_cache.invalidate(('version', namespace))
+        _log.info('invalidated cached results for %s' % namespace)
+
+    def prefetch_memoized(self, *calls):
+        """Prefetch several memoized method calls' results at once.
+
+        Each call is a tuple of a memoized method (bound to this handler), its
+        positional arguments, and its keyword arguments.  Fetch all of the
+        calls' cached results with one get_multi, and keep the fresh results
+        cached in this instance's memory, so that when we actually make the
+        calls, they don't have to hit memcache.
+        """
+        cls = self.__class__
+        methods = [method.uncached for method, args, kwds in calls]
+        cls._get_memoize_versions(methods)
+        keys = [cls._compute_memcache_key(self, method, args, kwds)
+                for method, (bound, args, kwds) in zip(methods, calls)]
+        now = time.time()
+        num_fresh = 0
+        for key, cached in memcache.get_multi(keys).items():
+            if isinstance(cached, tuple) and now < cached[1]:
+                ttl = min(MEMOIZE_LRU_TTL, cached[1] - now)
+                _memoize_cache.set(key, cached, ttl=ttl)
+                num_fresh += 1
+        _log.debug('prefetched %s of %s cached results' % (num_fresh,
+                                                            len(keys)))
+
+    @staticmethod
+    def _memoize_namespace(method):
+        """Compute the namespace (the unit of invalidation) of a memoized
+        method.
+        """
+        return method.__module__ + '.' + method.func_name
+
+    @staticmethod
+    def _seed_memoize_version():
+        """Compute a fresh version for a memoized method whose version isn't
+        memcached.
+
+        If memcache evicts a version, then we mustn't start counting again
+        from a version that we've used before (or we might serve results cached
+        before an invalidation).  So seed versions with the current time, in
+        milliseconds, which is later than any version that we've used before.
+        """
+        return int(time.time() * 1000)
+
+    @classmethod
+    def _get_memoize_versions(cls, methods):
+        """Return a dict mapping memoized methods' namespaces to their
+        versions.
+
+        Versions change rarely, so keep them cached in this instance's memory.
+        Fetch any that aren't with one get_multi, and seed any that aren't
+        memcached either.
+        """
+        versions, missed = {}, []
+        for method in methods:
+            namespace = cls._memoize_namespace(method)
+            version = _memoize_cache.get(('version', namespace))
+            if version is None:
+                missed.append(namespace)
+            else:
+                versions[namespace] = version
+        if missed:
+            memcached = memcache.get_multi(missed,
+                                           key_prefix=MEMOIZE_VERSION_PREFIX)
+            unseeded = [namespace for namespace in missed
+                        if not memcached.has_key(namespace)]
+            if unseeded:
+                # Use add rather than set, so that if someone else seeds (or
+                # bumps) a version at the same time, we use theirs.
+                seed = cls._seed_memoize_version()
+                memcache.add_multi(dict([(namespace, seed)
+                                         for namespace in unseeded]),
+                                   key_prefix=MEMOIZE_VERSION_PREFIX)
+                seeded = memcache.get_multi(unseeded,
+                                            key_prefix=MEMOIZE_VERSION_PREFIX)
+                for namespace in unseeded:
+                    memcached[namespace] = seeded.get(namespace, seed)
+            for namespace in missed:
+                version = memcached[namespace]
+                _memoize_cache.set(('version', namespace), version)
+                versions[namespace] = version
+        return versions
+
+    @classmethod
+    def _compute_memcache_key(cls, self, method, args, kwds):
         """Convert a method call into a signature for use as a memcache key.
 
         Take into account the module, class, and method names, positional
         argument values, and keyword argument names and values in order to
-        eliminate the possibility of a false positive memcache hit.
+        eliminate the possibility of a false positive memcache hit.  Then take
+        into account the method's version, and hash it all, so that the key is
+        short no matter how big the arguments are.
         """
 
         def stringify(arg):
@@ -129,12 +313,17 @@ class BaseHandler(object):
             s = quote + str(arg) + quote
             return s
 
-        memcache_key = str(type(self)).split("'")[1] + '.' + method.func_name + '('
-        memcache_key += ', '.join([stringify(arg) for arg in args])
+        signature = str(type(self)).split("'")[1] + '.' + method.func_name + '('
+        signature += ', '.join([stringify(arg) for arg in args])
         if args and kwds:
-            memcache_key += ', '
-        memcache_key += ', '.join([str(key) + '=' + stringify(kwds[key])
-                                   for key in kwds]) + ')'
+            signature += ', '
+        signature += ', '.join([str(key) + '=' + stringify(kwds[key])
+                                for key in sorted(kwds)]) + ')'
+
+        namespace = cls._memoize_namespace(method)
+        version = cls._get_memoize_versions([method])[namespace]
+        signature += ' v%s' % version
+        memcache_key = 'memoize_' + hashlib.sha1(signature).hexdigest()
         return memcache_key
 
     @staticmethod
@@ -205,170 +394,251 @@ class _CommonHandler(BaseHandler):
         """Pure virtual method."""
         raise NotImplementedError
 
-    def get_stats(self):
+    @classmethod
+    def get_stats(cls):
         """Return a dict containing all of the statistics that we track.
 
         We track the total number of users who've signed up for Social
         Butterfly, the number of users currently online and available for chat,
-        and the number of instant messages sent today.
+        the number of instant messages sent today, and the number of instant
+        messages sent in the last minute.
+
+        Every page view and presence fan-out reads our stats, so keep them
+        cached in this instance's memory for STATS_LRU_TTL seconds.
         """
+        stats = _stats_cache.get('stats')
+        if stats is None:
+            stats = cls._get_stats()
+            _stats_cache.set('stats', stats)
+        return dict(stats)
 
-        # First, try to get all of the stats from memcache.
+    @classmethod
+    def _get_stats(cls):
+        """Return a dict containing all of the statistics that we track."""
+
+        # The number of users, active users, and messages sent today are all
+        # sharding counters, which keep their totals memcached (and fall back
+        # to their datastored rollups).  The number of messages sent today
+        # (and per minute) are time-bucketed counters, so look up today's (and
+        # the last minute's) buckets.
         client = memcache.Client()
-        stats = [NUM_USERS_KEY, NUM_ACTIVE_USERS_KEY, NUM_MESSAGES_KEY]
-        stats = client.get_multi(stats)
-
-        # Next, if any of the stats wasn't memcached, fall back to computing
-        # that stat.
-        missed = {}
-        if not stats.has_key(NUM_USERS_KEY):
-            missed[NUM_USERS_KEY] = models.Account.num_users()
-        if not stats.has_key(NUM_ACTIVE_USERS_KEY):
-            missed[NUM_ACTIVE_USERS_KEY] = models.Account.num_active_users()
-        if not stats.has_key(NUM_MESSAGES_KEY):
-            # Since this stat is actually a sharding counter, our sharding
-            # counter implementation should keep this stat memcached.  So don't
-            # update memcache (leave that to our sharding counter
-            # implementation).  Only update our dict.
-            num_messages = shards.Shard.get_count(NUM_MESSAGES_KEY)
-            num_messages = 0 if num_messages is None else num_messages
-            stats[NUM_MESSAGES_KEY] = num_messages
-
-        # Finally, if we fell back to computing any of the stats, shove that
-        # stat back into memcache and into the dict that we're going to return.
-        if missed:
-            async = client.add_multi_async(missed)
-            stats.update(missed)
-            async.get_result()
+        num_messages_key = shards.TimeBuckets.name(NUM_MESSAGES_KEY)
+        messages_per_minute_key = shards.TimeBuckets.previous(NUM_MESSAGES_KEY)
+        async = client.get_multi_async([messages_per_minute_key])
+        names = [NUM_USERS_KEY, NUM_ACTIVE_USERS_KEY, num_messages_key]
+        counts = shards.Shard.get_count_multi(names)
+        messages_per_minute = async.get_result().get(messages_per_minute_key)
+
+        stats = {
+            NUM_USERS_KEY: counts.get(NUM_USERS_KEY, 0),
+            NUM_ACTIVE_USERS_KEY: counts.get(NUM_ACTIVE_USERS_KEY, 0),
+            NUM_MESSAGES_KEY: counts.get(num_messages_key, 0),
+            MESSAGES_PER_MINUTE_KEY: messages_per_minute or 0,
+        }
         return stats
 
     def update_stat(self, memcache_key, change):
         """ """
         assert change in (1, -1)
-        func_name = 'incr' if change == 1 else 'decr'
-        func = getattr(memcache, func_name)
-        value = func(memcache_key)
+        _stats_cache.invalidate()
+        value = shards.MemcacheCounter.incr(memcache_key, delta=change)
         if value is None:
-            if memcache_key == NUM_USERS_KEY:
-                value = models.Account.num_users()
-            elif memcache_key == NUM_ACTIVE_USERS_KEY:
-                value = models.Account.num_active_users()
-            if value is not None:
-                memcache.add(memcache_key, value)
+            # The stat isn't memcached.  The transactional task that applies
+            # this change to its datastored shards might have run already, or
+            # might not have, so don't add this change on top of them.  Just
+            # recompute the stat (and memcache it, unless someone beat us to
+            # it).  Reconciliation corrects any difference.
+            value = shards.Shard.get_count(memcache_key)
         return value
 
     def update_active_users(self, alice):
-        """ """
-        client = memcache.Client()
-        active_users = client.gets(ACTIVE_USERS_KEY)
-        if active_users is not None:
-            active = alice.started and alice.available
-            method_name = 'add' if active else 'discard'
-            method = getattr(active_users, method_name)
-            method(str(alice))
-            client.cas(ACTIVE_USERS_KEY, active_users)
+        """Alice has become available or unavailable for chat.  Update the
+        registry of active users.
+        """
+        registry.ActiveUsers.update(alice)
 
     def broadcast_stats(self):
-        """ """
-        stats = self.get_stats()
-        json = simplejson.dumps(stats)
-        channels.Channel.broadcast(json)
+        """Schedule broadcasting our stats to all channels.
 
-    def send_presence_to_all(self):
-        """ """
-        _log.info('deferring sending presence to all active users')
+        All of the stat changes within a STATS_BROADCAST_WINDOW second window
+        share one broadcast, which goes out at the end of the window and carries
+        the stats as of then.
+        """
         cls = self.__class__
-        active_users = memcache.get(ACTIVE_USERS_KEY)
-        stats = self.get_stats()
-        deferred_sending_presence = False
-
-        if active_users is not None:
-            if active_users:
-                deferred.defer(cls._send_presence_to_set, active_users, stats)
-                deferred_sending_presence = True
+        coalescing.Coalescer.defer(STATS_BROADCAST_KEY, STATS_BROADCAST_WINDOW,
+                                   cls._broadcast_stats)
+
+    @classmethod
+    def _broadcast_stats(cls, window):
+        """Broadcast our stats to all channels, for the given window."""
+        lateness = coalescing.Coalescer.lateness(STATS_BROADCAST_WINDOW, window)
+        if lateness > STATS_BROADCAST_MAX_STALENESS and \
+           coalescing.Coalescer.superseded(STATS_BROADCAST_KEY, window):
+            body = 'not broadcasting stats for window %s (%.1fs late, superseded)'
+            _log.warning(body % (window, lateness))
         else:
-            active_users = models.Account.get_users(started=True,
-                                                    available=True)
-            if active_users.count(1):
-                deferred.defer(cls._send_presence_to_query, active_users,
-                               stats)
-                deferred_sending_presence = True
+            stats = cls.get_stats()
+            message = cls._stats_message(stats)
+            if message is None:
+                _log.info('not broadcasting stats for window %s' % window)
             else:
-                active_users = set()
-                memcache.add(ACTIVE_USERS_KEY, active_users)
+                json = simplejson.dumps(message)
+                channels.Channel.broadcast(json, name=STATS_TOPIC)
 
-        if deferred_sending_presence:
-            _log.info('deferred sending presence to all active users')
-        else:
-            _log.info('not deferring sending presence (no active users)')
+    @staticmethod
+    def _stats_message(stats):
+        """Return the message to broadcast for the given stats.
+
+        Each message carries a sequence number and only the stats that changed
+        since the last message.  But every STATS_FULL_SNAPSHOT_EVERY messages
+        (and whenever memcache has lost track of the last message), the message
+        carries a full snapshot of the stats instead.  Return None if none of
+        the stats changed.
+        """
+        client = memcache.Client()
+        for retry in range(NUM_RETRIES):
+            previous = client.gets(STATS_SNAPSHOT_KEY)
+            if previous is None:
+                seq, full = 0, True
+            else:
+                seq = previous['seq'] + 1
+                full = seq % STATS_FULL_SNAPSHOT_EVERY == 0
+            if full:
+                changed = stats
+            else:
+                changed = dict([(key, value) for key, value in stats.items()
+                                if previous['stats'].get(key) != value])
+                if not changed:
+                    return None
+            snapshot = {'seq': seq, 'stats': stats}
+            if previous is None:
+                stored = client.add(STATS_SNAPSHOT_KEY, snapshot)
+            else:
+                stored = client.cas(STATS_SNAPSHOT_KEY, snapshot)
+            if stored:
+                return {'seq': seq, 'full': full, 'stats': changed}
+        _log.warning("couldn't sequence stats message")
+        return None
 
     @classmethod
-    def _send_presence_to_set(cls, carols, stats):
-        """ """
-        _log.info('sending presence to all active users')
-        num_carols = 0
-        sent_to = set()
-        try:
-            for carol in carols:
-                notifications.Notifications.status(carol, stats)
-                # There's a chance that Google App Engine will throw the
-                # DeadlineExceededError exception at this point in the flow of
-                # execution.  In this case, Carol will have already received
-                # our chat status, but the sent_to set will not have been
-                # updated.  So on the next go-around, Carol will receive our
-                # chat status again.  I'm just documenting this possibility,
-                # but it shouldn't be a big deal.
-                num_carols += 1
-                sent_to.add(carol)
-        except DeadlineExceededError:
-            _log.info('sent presence to %s users' % num_carols)
-            _log.warning('deadline; deferring presence to remaining users')
-            send_to = carols - sent_to
-            deferred.defer(cls._send_presence_to_set, send_to, stats)
+    def get_stats_snapshot(cls):
+        """Return a full snapshot of our stats, for a browser to resync with.
+
+        If memcache still has the last message's full stats, return those
+        (along with that message's sequence number), so that the browser can
+        apply the deltas that follow.  Otherwise, return the current stats
+        without a sequence number.
+        """
+        snapshot = memcache.get(STATS_SNAPSHOT_KEY)
+        if snapshot is None:
+            snapshot = {'seq': None, 'stats': cls.get_stats()}
+        snapshot['full'] = True
+        return snapshot
+
+    def send_presence_to_all(self):
+        """Schedule sending our presence to all active users.
+
+        All of the state changes within a PRESENCE_WINDOW second window (an
+        epoch) share one fan-out, which goes out at the end of the epoch and
+        carries the stats as of then.
+        """
+        cls = self.__class__
+        epoch = coalescing.Coalescer.defer(PRESENCE_KEY, PRESENCE_WINDOW,
+                                           cls._send_presence_to_all)
+        if epoch is None:
+            _log.debug('already deferred sending presence for this epoch')
         else:
-            _log.info('sent presence to %s users' % num_carols)
-            _log.info('sent presence to all active users')
+            _log.info('deferred sending presence for epoch %s' % epoch)
 
     @classmethod
-    def _send_presence_to_query(cls, carols, stats, cursor=None):
-        """ """
-        _log.info('sending presence to all active users')
-        if cursor is not None:
-            carols = carols.with_cursor(cursor)
-        num_carols = 0
+    def _send_presence_to_all(cls, epoch):
+        """Send our presence to all active users, for the given epoch."""
+        if not cls._start_epoch(epoch):
+            return
+        _log.info('sending presence to all active users for epoch %s' % epoch)
+        stats = cls.get_stats()
+
+        # Split the fan-out across PRESENCE_WORKERS parallel tasks, each with
+        # its own share of the registry buckets.  Each task checkpoints (and
+        # defers) its own progress, independently of the others.
+        for worker in range(PRESENCE_WORKERS):
+            buckets = range(worker, ACTIVE_USERS_BUCKETS, PRESENCE_WORKERS)
+            if buckets:
+                deferred.defer(cls._send_presence_to_buckets, buckets, stats,
+                               epoch=epoch)
+        _log.info('deferred presence to %s workers' % PRESENCE_WORKERS)
 
+    @staticmethod
+    def _start_epoch(epoch):
+        """Record that the given epoch's presence fan-out is starting.
+
+        Return False (and don't record anything) if a later epoch's fan-out has
+        already started, in which case this epoch's fan-out would only send
+        stale stats.  A fan-out that has started always runs to completion, no
+        matter how many later epochs are scheduled meanwhile, so that users in
+        its last buckets still hear from us.
+        """
+        key = PRESENCE_KEY + '_started'
         client = memcache.Client()
-        active_users, memcached = client.gets(ACTIVE_USERS_KEY), True
-        if active_users is None:
-            active_users, memcached = set(), False
+        for retry in range(NUM_RETRIES):
+            started = client.gets(key)
+            if started is None:
+                if client.add(key, epoch):
+                    return True
+            elif started > epoch:
+                body = 'presence for epoch %s superseded by epoch %s; dropping'
+                _log.info(body % (epoch, started))
+                return False
+            elif client.cas(key, epoch):
+                return True
+        return True
 
+    @classmethod
+    def _send_presence_to_buckets(cls, buckets, stats, carols=None,
+                                  epoch=None):
+        """Send our presence to the active users in the given registry buckets.
+
+        We get all of our buckets at once, then work through them one by one,
+        and through each bucket's users in chunks.  If we run out of time, then
+        we defer the rest: the buckets that we haven't started yet, plus the
+        users that we haven't reached yet (carols) in the bucket that we were
+        working on.
+        """
+        _log.info('sending presence to %s registry buckets' % len(buckets))
+        buckets = list(buckets)
+        num_buckets, num_carols = len(buckets), 0
         try:
-            for carol in carols:
-                carol = carol.name()
-                carol = models.Account.key_to_handle(carol)
-                notifications.Notifications.status(carol, stats)
-                # There's a chance that Google App Engine will throw the
-                # DeadlineExceededError exception at this point in the flow of
-                # execution.  In this case, Carol will have already received
-                # our chat status, but the cursor will not have been updated.
-                # So on the next go-around, Carol will receive our chat status
-                # again.  I'm just documenting this possibility, but it
-                # shouldn't be a big deal.
-                cursor = carols.cursor()
-                num_carols += 1
-                active_users.add(carol)
+            handles = registry.ActiveUsers.get_multi(buckets if carols is None
+                                                     else buckets[1:])
+            while buckets:
+                if carols is None:
+                    carols = list(handles[buckets[0]])
+                while carols:
+                    chunk = carols[:PRESENCE_CHUNK_SIZE]
+                    num_sent = notifications.Notifications.status_multi(chunk,
+                                                                        stats)
+                    # There's a chance that Google App Engine will throw the
+                    # DeadlineExceededError exception at this point in the
+                    # flow of execution.  In this case, everyone in this chunk
+                    # will have already received our chat status, but the
+                    # carols list will not have been updated.  So on the next
+                    # go-around, they'll receive our chat status again.  I'm
+                    # just documenting this possibility, but it shouldn't be a
+                    # big deal.
+                    carols = carols[PRESENCE_CHUNK_SIZE:]
+                    num_carols += num_sent
+                    body = 'sent presence to chunk of %s users (%s so far)'
+                    _log.info(body % (num_sent, num_carols))
+                buckets.pop(0)
+                carols = None
         except DeadlineExceededError:
             _log.info('sent presence to %s users' % num_carols)
             _log.warning('deadline; deferring presence to remaining users')
-            deferred.defer(cls._send_presence_to_query, carols, stats,
-                           cursor=cursor)
+            deferred.defer(cls._send_presence_to_buckets, buckets, stats,
+                           carols=carols, epoch=epoch)
         else:
             _log.info('sent presence to %s users' % num_carols)
-            _log.info('sent presence to all active users')
-        finally:
-            method_name = 'cas' if memcached else 'add'
-            method = getattr(client, method_name)
-            method(ACTIVE_USERS_KEY, active_users)
+            _log.info('sent presence to %s registry buckets' % num_buckets)
 
 
 class WebHandler(_CommonHandler, webapp.RequestHandler):
@@ -0,0 +1,127 @@
+#-----------------------------------------------------------------------------#
+#   waiting_queue.py                                                          #
+#                                                                             #
+#   Copyright (c) 2010-2012, Code A La Mode, original authors.                #
+#                                                                             #
+#       This file is part of Social Butterfly.                                #
+#                                                                             #
+#       Social Butterfly is free software; you can redistribute it and/or     #
+#       modify it under the terms of the GNU General Public License as        #
+#       published by the Free Software Foundation, either version 3 of the    #
+#       License, or (at your option) any later version.                       #
+#                                                                             #
+#       Social Butterfly is distributed in the hope that it will be useful,   #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#       GNU General Public License for more details.                          #
+#                                                                             #
+#       You should have received a copy of the GNU General Public License     #
+#       along with Social Butterfly.  If not, see:                            #
+#           <http://www.gnu.org/licenses/>.                                   #
+#-----------------------------------------------------------------------------#
+"""Benchmark pairing latency against the number of users waiting to chat.
+
+Finding Alice a chat partner pops candidates off of the memcached waiting queue
+and gets their accounts by key name, so it should cost the same no matter how
+many users are waiting.  This script checks that against the App Engine SDK's
+memcache and datastore stubs, for 10 through 100,000 waiting users.
+
+Run it with the App Engine SDK's Python 2 interpreter, from the root of the
+project:
+
+    python benchmarks/waiting_queue.py /path/to/google_appengine
+
+Filling the datastore stub with 100,000 accounts takes a few minutes; the
+timings only cover pairing, not the setup.
+"""
+
+
+import os
+import sys
+import time
+
+
+POOL_SIZES = (10, 100, 1000, 10000, 100000)
+NUM_PAIRINGS = 1000
+BATCH_SIZE = 500
+
+
+def _fix_sys_path(sdk_path):
+    """Make the App Engine SDK and the project importable."""
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _account(models, index):
+    """Build (but don't put) the account for the fake user at the given
+    index."""
+    from google.appengine.ext import db
+    handle = 'stranger%s@gmail.com' % index
+    key_name = models.Account.handle_to_key(handle)
+    return models.Account(key_name=key_name, handle=db.IM('xmpp', handle),
+                          started=True, available=True)
+
+
+def _percentile(timings, percent):
+    """Return the given percentile of the given (sorted) timings."""
+    index = min(len(timings) - 1, int(len(timings) * percent / 100.0))
+    return timings[index]
+
+
+def _benchmark(pool_size):
+    """Time NUM_PAIRINGS pairings with pool_size users waiting to chat.
+
+    Every time that Alice finds a chat partner, Carol, we push Carol back onto
+    the queue, so that the same number of users are waiting throughout.
+    """
+    from google.appengine.ext import db
+    from google.appengine.ext import testbed
+    import models
+    import strangers
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    try:
+        accounts = []
+        for index in range(pool_size):
+            accounts.append(_account(models, index))
+            if len(accounts) >= BATCH_SIZE:
+                db.put(accounts)
+                accounts = []
+        db.put(accounts)
+        strangers.WaitingQueue.rebuild()
+
+        timings = []
+        for index in range(NUM_PAIRINGS):
+            alice = _account(models, pool_size + index)
+            before = time.time()
+            carol = strangers.Strangers._find_partner(alice)
+            timings.append(time.time() - before)
+            assert carol is not None
+            strangers.WaitingQueue.push(carol)
+        timings.sort()
+        return timings
+    finally:
+        bed.deactivate()
+
+
+def main(sdk_path):
+    """Print pairing latencies, in milliseconds, for each pool size."""
+    _fix_sys_path(sdk_path)
+    print '%10s %10s %10s %10s' % ('waiting', 'median', 'p95', 'max')
+    for pool_size in POOL_SIZES:
+        timings = _benchmark(pool_size)
+        print '%10d %10.3f %10.3f %10.3f' % (
+            pool_size, _percentile(timings, 50) * 1000,
+            _percentile(timings, 95) * 1000, timings[-1] * 1000)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: python %s /path/to/google_appengine' % sys.argv[0])
+    main(sys.argv[1])
@@ -25,13 +25,23 @@
 import datetime
 import logging
 import random
+import threading
+import time
 
+from google.appengine.api import api_base_pb
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import channel
+from google.appengine.api import memcache
+from google.appengine.api.channel import channel_service_pb
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 from google.appengine.runtime import DeadlineExceededError
+from google.appengine.runtime import apiproxy_errors
 
-from config import NUM_RETRIES
+from config import CHANNEL_ID_BLOCK_SIZE
+from config import CHANNEL_PARTITIONS, CHANNEL_BATCH_SIZE
+from config import CHANNEL_RPCS_IN_FLIGHT
+from config import CHANNEL_SWEEP_BATCH_SIZE, CHANNEL_SWEEP_BATCHES
 
 
 _log = logging.getLogger(__name__)
@@ -47,31 +57,67 @@ class Channel(db.Model):
     """
 
     name = db.StringProperty()
+    partition = db.IntegerProperty()
     datetime = db.DateTimeProperty(required=True, auto_now=True)
 
+    # This instance's block of pre-allocated channel IDs: the next ID to hand
+    # out, and the last ID in the block.
+    _next_id, _last_id = 0, -1
+    _id_lock = threading.Lock()
+
+    @classmethod
+    def _allocate_id(cls):
+        """Return a channel ID that no one else has or will ever have.
+
+        We used to guess random IDs in a transaction, checking each guess with
+        a get.  Instead, every instance reserves a block of CHANNEL_ID_BLOCK_SIZE
+        IDs from the datastore, then hands them out one at a time without any
+        datastore RPCs until the block runs out.
+        """
+        cls._id_lock.acquire()
+        try:
+            if cls._next_id > cls._last_id:
+                key = db.Key.from_path(cls.kind(), 1)
+                first, last = db.allocate_ids(key, CHANNEL_ID_BLOCK_SIZE)
+                cls._next_id, cls._last_id = first, last
+                _log.info('allocated channel IDs %s through %s' % (first, last))
+            channel_id = cls._next_id
+            cls._next_id += 1
+        finally:
+            cls._id_lock.release()
+        return channel_id
+
     @classmethod
     def create(cls, name=None):
-        """Create a channel and return its token."""
+        """Create a channel and return its token.
+
+        We don't persist anything about the channel yet; we only encode its
+        name (topic) in its client ID.  The channel becomes a broadcast target
+        once its browser actually connects (see connect).
+        """
         _log.info('creating channel')
+        client_id = 'channel' + str(cls._allocate_id())
+        if name is not None:
+            client_id += '_' + name
+        token = channel.create_channel(client_id)
+        _log.info('created channel %s, token %s' % (client_id, token))
+        return token
 
-        def txn():
-            for retry in range(NUM_RETRIES):
-                client_id = 'client' + str(random.randint(0, 10 ** 8 - 1))
-                chan = cls.get_by_key_name(client_id)
-                if chan is None:
-                    chan = cls(key_name=client_id, name=name)
-                    chan.put()
-                    return client_id
-
-        client_id = db.run_in_transaction(txn)
-        if client_id is None:
-            _log.warning("couldn't create channel; couldn't allocate ID")
-        else:
-            token = channel.create_channel(client_id)
-            _countdown = 2 * 60 * 60
-            deferred.defer(cls.destroy, client_id, _countdown=_countdown)
-            _log.info('created channel %s, token %s' % (client_id, token))
-            return token
+    @classmethod
+    def connect(cls, client_id):
+        """The specified channel has connected.  Make it a broadcast target.
+
+        Stale channels (whose browsers never sent disconnect messages) are
+        destroyed in bulk, by the flush-channels cron job.
+        """
+        _log.info('connecting channel %s' % client_id)
+        name = None
+        if '_' in client_id:
+            name = client_id.split('_', 1)[1]
+        partition = random.randint(0, CHANNEL_PARTITIONS - 1)
+        chan = cls(key_name=client_id, name=name, partition=partition)
+        chan.put()
+        _log.info('connected channel %s' % client_id)
 
     @classmethod
     def destroy(cls, client_id):
@@ -87,57 +133,188 @@ class Channel(db.Model):
 
     @classmethod
     def broadcast(cls, json, name=None):
-        """Schedule broadcasting the specified JSON string to all channels."""
+        """Schedule broadcasting the specified JSON string to all channels.
+
+        Every channel belongs to one of CHANNEL_PARTITIONS partitions (chosen
+        at random when the channel is created).  We broadcast to each partition
+        in its own task, in parallel.
+        """
         _log.info('deferring broadcasting JSON to all connected channels')
         channels = cls.all()
         if name is not None:
             channels = channels.filter('name =', name)
         channels = channels.count(1)
         if channels:
-            deferred.defer(cls._broadcast, json, name=name, cursor=None)
-            _log.info('deferred broadcasting JSON to all connected channels')
+            started = time.time()
+            broadcast_id = '%d_%08x' % (started, random.getrandbits(32))
+            mapping = {'workers': CHANNEL_PARTITIONS, 'channels': 0}
+            key_prefix = cls._broadcast_key_prefix(broadcast_id)
+            memcache.set_multi(mapping, time=60 * 60, key_prefix=key_prefix)
+            for partition in range(CHANNEL_PARTITIONS):
+                deferred.defer(cls._broadcast, json, name=name,
+                               partition=partition, cursor=None,
+                               broadcast_id=broadcast_id, started=started)
+            body = 'deferred broadcasting JSON to all connected channels (%s)'
+            _log.info(body % broadcast_id)
         else:
             body = 'not deferring broadcasting JSON (no connected channels)'
             _log.info(body)
 
     @classmethod
-    def _broadcast(cls, json, name=None, cursor=None):
-        """Broadcast the specified JSON string to all channels."""
-        _log.info('broadcasting JSON to all connected channels')
+    def _broadcast(cls, json, name=None, partition=None, cursor=None,
+                   broadcast_id=None, started=None):
+        """Broadcast the specified JSON string to one partition's channels."""
+        _log.info('broadcasting JSON to channels in partition %s' % partition)
         keys = cls.all(keys_only=True)
         if name is not None:
             keys = keys.filter('name = ', name)
+        if partition is not None:
+            keys = keys.filter('partition =', partition)
         if cursor is not None:
             keys = keys.with_cursor(cursor)
         num_channels = 0
         try:
-            for key in keys:
-                client_id = key.name()
-                channel.send_message(client_id, json)
+            chunk = keys.fetch(CHANNEL_BATCH_SIZE)
+            while chunk:
+                client_ids = [key.name() for key in chunk]
+                num_channels += cls._send_multi(client_ids, json)
                 # There's a chance that Google App Engine will throw the
                 # DeadlineExceededError exception at this point in the flow of
-                # execution.  In this case, the current channel will have
-                # already received our JSON broadcast, but the cursor will not
-                # have been updated.  So on the next go-around, the current
-                # channel will receive our JSON broadcast again.  I'm just
+                # execution.  In this case, the current chunk of channels will
+                # have already received our JSON broadcast, but the cursor will
+                # not have been updated.  So on the next go-around, the current
+                # chunk will receive our JSON broadcast again.  I'm just
                 # documenting this possibility, but it shouldn't be a big deal.
                 cursor = keys.cursor()
-                num_channels += 1
+                keys = keys.with_cursor(cursor)
+                chunk = keys.fetch(CHANNEL_BATCH_SIZE)
         except DeadlineExceededError:
             _log.info('broadcasted JSON to %s channels' % num_channels)
             _log.warning("deadline; deferring broadcast to remaining channels")
-            deferred.defer(cls._broadcast, json, name=name, cursor=cursor)
+            cls._report_broadcast(broadcast_id, started, num_channels)
+            deferred.defer(cls._broadcast, json, name=name,
+                           partition=partition, cursor=cursor,
+                           broadcast_id=broadcast_id, started=started)
         else:
             _log.info('broadcasted JSON to %s channels' % num_channels)
-            _log.info('broadcasted JSON to all connected channels')
+            body = 'broadcasted JSON to all channels in partition %s'
+            _log.info(body % partition)
+            cls._report_broadcast(broadcast_id, started, num_channels,
+                                  done=True)
+
+    @staticmethod
+    def _send_multi(client_ids, json):
+        """Send the specified JSON string to many channels, with several RPCs
+        in flight.
+
+        channel.send_message waits for its RPC to complete before returning.
+        So instead, we make the same RPCs ourselves, asynchronously, keeping up
+        to CHANNEL_RPCS_IN_FLIGHT of them in flight at once.  Return the number
+        of channels that we sent the JSON string to.
+        """
+        rpcs = []
+        num_sent = 0
+        for client_id in client_ids:
+            if len(rpcs) >= CHANNEL_RPCS_IN_FLIGHT:
+                num_sent += Channel._wait_for_message(rpcs.pop(0))
+            request = channel_service_pb.SendMessageRequest()
+            response = api_base_pb.VoidProto()
+            request.set_application_key(client_id)
+            request.set_message(json)
+            rpc = apiproxy_stub_map.UserRPC('channel')
+            rpc.make_call('SendChannelMessage', request, response)
+            rpcs.append(rpc)
+        for rpc in rpcs:
+            num_sent += Channel._wait_for_message(rpc)
+        return num_sent
+
+    @staticmethod
+    def _wait_for_message(rpc):
+        """Wait for a channel message RPC to complete.  Return 1 if it
+        succeeded.
+        """
+        try:
+            rpc.check_success()
+        except apiproxy_errors.ApplicationError, e:
+            body = "couldn't send channel message (error %s)"
+            _log.warning(body % e.application_error)
+            return 0
+        return 1
+
+    @staticmethod
+    def _broadcast_key_prefix(broadcast_id):
+        """Compute the memcache key prefix for a broadcast's progress."""
+        return 'broadcast_%s_' % broadcast_id
 
     @classmethod
-    def flush(cls):
-        """Destroy all channels created over two hours ago."""
+    def _report_broadcast(cls, broadcast_id, started, num_channels, done=False):
+        """Record a partition's progress on a broadcast.
+
+        When the last partition finishes, log how many channels the broadcast
+        reached, and how long it took to reach them all.
+        """
+        if broadcast_id is None:
+            return
+        key_prefix = cls._broadcast_key_prefix(broadcast_id)
+        total = memcache.incr(key_prefix + 'channels', delta=num_channels)
+        if done:
+            workers = memcache.decr(key_prefix + 'workers')
+            if workers == 0:
+                elapsed = time.time() - started
+                body = 'broadcast %s reached %s channels in %.2fs'
+                _log.info(body % (broadcast_id, total, elapsed))
+                memcache.delete_multi(['workers', 'channels'],
+                                      key_prefix=key_prefix)
+
+    @classmethod
+    def flush(cls, expiry=None, cursor=None, num_deleted=0):
+        """Destroy all channels created over two hours ago.
+
+        We delete the stale channels in batches of CHANNEL_SWEEP_BATCH_SIZE,
+        with each batch's delete in flight while we fetch the next batch.
+        After CHANNEL_SWEEP_BATCHES batches (or if we run out of time), we
+        defer the rest of the sweep, from where we left off.
+        """
         _log.info('destroying all channels over two hours old')
-        now = datetime.datetime.now()
-        timeout = datetime.timedelta(hours=2)
-        expiry = now - timeout
+        if expiry is None:
+            now = datetime.datetime.now()
+            timeout = datetime.timedelta(hours=2)
+            expiry = now - timeout
         keys = cls.all(keys_only=True).filter('datetime <=', expiry)
-        db.delete(keys)
-        _log.info('destroyed all channels over two hours old')
+        if cursor is not None:
+            keys = keys.with_cursor(cursor)
+
+        # cursor is our checkpoint: it only moves past a batch once that
+        # batch's delete has gone through.
+        rpc, done = None, False
+        try:
+            for batch in range(CHANNEL_SWEEP_BATCHES):
+                chunk = keys.fetch(CHANNEL_SWEEP_BATCH_SIZE)
+                next_cursor = keys.cursor()
+                if rpc is not None:
+                    rpc.get_result()
+                    num_deleted += len(pending)
+                    cursor, rpc = pending_cursor, None
+                if not chunk:
+                    done = True
+                    break
+                rpc = db.delete_async(chunk)
+                pending, pending_cursor = chunk, next_cursor
+                keys = keys.with_cursor(next_cursor)
+            if rpc is not None:
+                rpc.get_result()
+                num_deleted += len(pending)
+                cursor = pending_cursor
+        except DeadlineExceededError:
+            # If a batch's delete was still in flight, then our checkpoint is
+            # still from before that batch, so on the next go-around, we'll
+            # fetch (and delete) those channels again.
+            _log.warning('deadline; deferring destroying remaining channels')
+        if done:
+            body = 'destroyed all channels over two hours old (%s channels)'
+            _log.info(body % num_deleted)
+        else:
+            _log.info('destroyed %s channels so far' % num_deleted)
+            deferred.defer(cls.flush, expiry=expiry, cursor=cursor,
+                           num_deleted=num_deleted)
+        return num_deleted
@@ -0,0 +1,101 @@
+#-----------------------------------------------------------------------------#
+#   coalescing.py                                                             #
+#                                                                             #
+#   Copyright (c) 2010-2012, Code A La Mode, original authors.                #
+#                                                                             #
+#       This file is part of Social Butterfly.                                #
+#                                                                             #
+#       Social Butterfly is free software; you can redistribute it and/or     #
+#       modify it under the terms of the GNU General Public License as        #
+#       published by the Free Software Foundation, either version 3 of the    #
+#       License, or (at your option) any later version.                       #
+#                                                                             #
+#       Social Butterfly is distributed in the hope that it will be useful,   #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#       GNU General Public License for more details.                          #
+#                                                                             #
+#       You should have received a copy of the GNU General Public License     #
+#       along with Social Butterfly.  If not, see:                            #
+#           <http://www.gnu.org/licenses/>.                                   #
+#-----------------------------------------------------------------------------#
+"""Coalesce bursts of work into at most one deferred task per time window.
+
+Some of our work (broadcasting stats, for example) is triggered by events that
+can happen hundreds of times per second, but only needs to be done once for all
+of those events.  So we chop time up into fixed-length windows, and no matter
+how many times the work is requested within a window, we defer just one named
+task to do it at the end of the window.
+"""
+
+
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+
+
+_log = logging.getLogger(__name__)
+
+
+class Coalescer(object):
+    """Public API to coalesce work into one deferred task per time window."""
+
+    @staticmethod
+    def window(seconds, now=None):
+        """Compute the index of the window (of the given length) containing now."""
+        if now is None:
+            now = time.time()
+        return int(now // seconds)
+
+    @classmethod
+    def defer(cls, name, seconds, func, *args, **kwds):
+        """Defer func to run at the end of the current window, at most once.
+
+        func is called with the window's index as its first argument, followed
+        by the rest of the given arguments.  Return the window's index if this
+        call deferred func, or None if func had already been deferred for this
+        window.
+        """
+        now = time.time()
+        window = cls.window(seconds, now=now)
+
+        # Before we bother the task queue, check memcache to see if someone has
+        # already deferred the task for this window.  If memcache has evicted
+        # our flag, then the task name will still stop us from deferring the
+        # task twice.
+        flag = '%s_window_%s' % (name, window)
+        if not memcache.add(flag, True, time=int(seconds) + 1):
+            return None
+
+        memcache.set(name + '_window', window)
+        task_name = '%s-%s' % (name.replace('_', '-'), window)
+        countdown = (window + 1) * seconds - now
+        kwds['_name'] = task_name
+        kwds['_countdown'] = countdown
+        try:
+            deferred.defer(func, window, *args, **kwds)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            _log.debug('task %s already deferred' % task_name)
+            return None
+        _log.debug('deferred task %s' % task_name)
+        return window
+
+    @staticmethod
+    def latest(name):
+        """Return the index of the most recent window with a deferred task."""
+        return memcache.get(name + '_window')
+
+    @classmethod
+    def superseded(cls, name, window):
+        """Return whether a later window than the given one has a deferred task."""
+        latest = cls.latest(name)
+        return latest is not None and latest > window
+
+    @staticmethod
+    def lateness(seconds, window):
+        """Return how many seconds after the end of the given window it is now."""
+        return time.time() - (window + 1) * seconds
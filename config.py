@@ -53,10 +53,160 @@ TEMPLATES = os.path.join(_CURRENT_PATH, 'templates')
 DEFAULT_NUM_SHARDS = 20
 NUM_RETRIES = 3
 
+# Hot memcached counters (such as the number of messages sent today) are split
+# across this many memcache keys, so that no one memcache server takes every
+# increment.
+MEMCACHE_COUNTER_SHARDS = 8
+
+# Buffered sharding counter increments are flushed to the datastore at most
+# once per this many seconds.  If memcache evicts a counter's buffer before it's
+# flushed, then we lose at most this many seconds' worth of increments.
+SHARD_FLUSH_INTERVAL = 10
+
+# A sharding counter's rollup (the total of its shards) is recomputed from its
+# shards at most once per this many seconds after the counter is incremented,
+# rather than written on every increment.
+SHARD_ROLLUP_INTERVAL = 60
+
+# If a sharding counter's increments' transactions collide this many times
+# within this many seconds, then we double its number of shards, up to a
+# maximum.
+SHARD_CONTENTION_THRESHOLD = 10
+SHARD_CONTENTION_WINDOW = 60
+MAX_NUM_SHARDS = 160
+
+# Time-bucketed counters (such as the number of messages sent today) roll over
+# to new buckets at midnight in this time zone (US Central Time, which is 6
+# hours behind UTC, or 5 hours behind during US daylight saving time)...
+TIME_BUCKET_UTC_OFFSET = -6
+TIME_BUCKET_DST = True
+
+# ...and every night, we compact this many days' worth of old buckets.
+TIME_BUCKET_COMPACT_DAYS = 7
+
+# Some hot values are also cached in each instance's memory (in front of
+# memcache), in LRU caches of up to these many entries, for up to these many
+# seconds.  Each cache logs its hit rate every LRU_REPORT_EVERY lookups.
+SHARD_CONFIG_LRU_SIZE = 100
+SHARD_CONFIG_LRU_TTL = 60
+STATS_LRU_TTL = 1
+MEMOIZE_LRU_SIZE = 50
+MEMOIZE_LRU_TTL = 60
+LRU_REPORT_EVERY = 1000
+
+# When a memoized method's cached results go stale, one caller takes a lock for
+# up to this many seconds while it recomputes them (and every other caller
+# keeps getting the stale results).
+MEMOIZE_LOCK_SECS = 60
+
+# Each memoized method's version (which is part of all of its memcache keys) is
+# memcached under this prefix.
+MEMOIZE_VERSION_PREFIX = 'memoize_version_'
+
+# When we reconcile memcache with the datastore, a memcached counter has to look
+# drifted twice, this many seconds apart, before we correct it.  (A counter can
+# look drifted for a moment, while an increment is on its way.)
+RECONCILE_SETTLE_SECS = 60
+
+# When we reconcile users' memcached routes, we check them in batches of this
+# many users.
+RECONCILE_BATCH_SIZE = 200
+
+# Each deferred task that reconciles memcache with the datastore checks at most
+# this many batches (or active users registry buckets) before it defers the
+# rest, from where it left off.
+RECONCILE_BATCHES = 10
+
+# Every memcached route (from a chatting user to his/her partner) expires after
+# this many seconds, so that a route that we failed to clear can't relay IMs to
+# an ex-partner forever.  After a route expires, the next IM looks up the route
+# in the datastore and memcaches it again.
+ROUTES_TTL = 60 * 60
+
 NUM_USERS_KEY = 'num_users'
 NUM_ACTIVE_USERS_KEY = 'num_active_users'
 NUM_MESSAGES_KEY = 'num_messages'
+MESSAGES_PER_MINUTE_KEY = 'messages_per_minute'
 ACTIVE_USERS_KEY = 'active_users'
+WAITING_QUEUE_KEY = 'waiting_queue'
+ROUTES_KEY = 'routes'
+STATS_BROADCAST_KEY = 'stats_broadcast'
+STATS_SNAPSHOT_KEY = 'stats_snapshot'
+PRESENCE_KEY = 'presence'
+
+# When Alice is looking for a chat partner, this is the maximum number of users
+# that we pop off of the waiting queue and consider before we give up and put
+# Alice on the waiting queue herself.
+NUM_PARTNER_CANDIDATES = 10
+
+# Pushing Alice onto the waiting queue takes two memcache RPCs: one to claim a
+# slot, and another to fill it.  When we pop an empty slot, we leave it alone
+# for this many seconds (in case someone is still in the middle of pushing onto
+# it) before we skip it.  This is also how long we wait to push Alice onto the
+# queue while it's being rebuilt.
+WAITING_QUEUE_SLOT_TIMEOUT = 10
+
+# Every time that Alice types /next, her partner goes into her blacklist (so
+# that she won't be paired with him/her again this session).  This is the
+# maximum number of partners that we remember; past this, we forget the oldest.
+MAX_BLACKLIST_LEN = 100
+
+# Our stats change on every relayed message, every /start and /stop, and every
+# sign up.  Rather than broadcast the stats to every channel on every change, we
+# merge all of the changes within a window (in seconds) into one broadcast...
+STATS_BROADCAST_WINDOW = 1
+
+# ...and if a window's broadcast runs more than this many seconds late (say,
+# because the task queue is backed up), and a later window's broadcast is
+# already on its way, then we drop the late broadcast.
+STATS_BROADCAST_MAX_STALENESS = 5
+
+# Each stats broadcast only carries the stats that changed since the previous
+# broadcast, except every this many broadcasts, which carry a full snapshot (so
+# that browsers that missed a broadcast catch up).
+STATS_FULL_SNAPSHOT_EVERY = 30
+
+# The memcached registry of active users is split into this many buckets (by
+# hash of handle), so that no one memcached value gets too big.
+ACTIVE_USERS_BUCKETS = 64
+
+# Our presence (which carries our stats) changes every time that someone signs
+# up, or becomes available or unavailable for chat.  Rather than send our
+# presence to every active user on every change, we merge all of the changes
+# within an epoch (in seconds) into one fan-out.
+PRESENCE_WINDOW = 10
+
+# When we send our presence to every active user, we send it in chunks of this
+# many users (checkpointing our progress after each chunk), with up to this many
+# presence RPCs in flight at once.
+PRESENCE_CHUNK_SIZE = 100
+PRESENCE_RPCS_IN_FLIGHT = 20
+
+# Each presence fan-out is split across this many parallel tasks, each of which
+# sends to its own share of the active users registry's buckets.
+PRESENCE_WORKERS = 8
+
+# Every channel subscribes to one of these topics, and only receives broadcasts
+# published to its topic.  (Browsers that render our stats subscribe to the
+# stats topic.)
+CHANNEL_TOPICS = ('stats', 'home', 'album')
+STATS_TOPIC = 'stats'
+
+# Every instance reserves channel IDs from the datastore in blocks of this many,
+# and hands them out without any further datastore RPCs.
+CHANNEL_ID_BLOCK_SIZE = 100
+
+# Every channel belongs to one of this many partitions, and we broadcast to
+# each partition in its own task, in parallel.  Each task fetches its channels
+# in batches of this many, with up to this many send RPCs in flight at once.
+CHANNEL_PARTITIONS = 8
+CHANNEL_BATCH_SIZE = 100
+CHANNEL_RPCS_IN_FLIGHT = 20
+
+# Stale channels are swept in batches of this many, and each sweep task deletes
+# at most this many batches before it defers the rest of the sweep.
+CHANNEL_SWEEP_BATCH_SIZE = 200
+CHANNEL_SWEEP_BATCHES = 10
 
 
 # The local part (the part before the at (@) symbol) of Gmail addresses must be
@@ -24,16 +24,22 @@
 
 import datetime
 import logging
+import os
 
-from google.appengine.api import memcache
+from django.utils import simplejson
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
 from config import DEBUG
-from config import NUM_ACTIVE_USERS_KEY, NUM_MESSAGES_KEY
+from config import CHANNEL_TOPICS, STATS_TOPIC
+from config import NUM_USERS_KEY, NUM_ACTIVE_USERS_KEY, NUM_MESSAGES_KEY
 import availability
 import base
 import channels
+import models
 import notifications
+import registry
 import shards
 import strangers
 
@@ -53,18 +59,38 @@ class Token(base.WebHandler):
     """Request handler to create a channel and return its token."""
 
     def get(self):
-        """Create a channel and return its token."""
+        """Create a channel subscribed to a topic and return its token.
+
+        Older clients don't specify a topic, and only ever wanted our stats.
+        So if the client didn't specify a topic, subscribe it to our stats.
+        """
         _log.info('someone has requested token to open channel')
-        if DEBUG:
+        topic = self.request.get('topic') or STATS_TOPIC
+        if topic not in CHANNEL_TOPICS:
+            _log.warning('not opening channel (unknown topic %s)' % topic)
+            self.serve_error(400)
+        elif DEBUG:
             _log.info('running on SDK; not opening channel (too much CPU)')
             self.serve_error(503)
         else:
             _log.info('running on cloud; creating channel, returning token')
-            token = channels.Channel.create()
+            token = channels.Channel.create(name=topic)
             self.response.out.write(token)
             _log.info('created channel, returned token')
 
 
+class Stats(base.WebHandler):
+    """Request handler to return a full snapshot of our stats (as JSON)."""
+
+    def get(self):
+        """Return a full snapshot of our stats, for a browser to resync with."""
+        _log.info('someone has requested stats snapshot')
+        snapshot = self.get_stats_snapshot()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps(snapshot))
+        _log.info('returned stats snapshot')
+
+
 class CronDispatch(base.WebHandler):
     """Request handler to run cron jobs."""
 
@@ -79,11 +105,17 @@ class CronDispatch(base.WebHandler):
         else:
             method()
 
-    def _reset_stats(self):
-        """Reset the interesting statistics."""
-        _log.info('cron resetting num messages sharding counter')
-        shards.Shard.reset(NUM_MESSAGES_KEY)
-        _log.info('cron reset num messages sharding counter')
+    def _compact_stats(self):
+        """Compact the interesting statistics.
+
+        The number of messages sent is a time-bucketed counter, so it doesn't
+        need to be reset at midnight; we just start incrementing the new day's
+        bucket.  But old buckets' shards are dead weight, so periodically, cron
+        sends a request to call this method to fold them into their totals.
+        """
+        _log.info('cron compacting num messages sharding counters')
+        shards.TimeBuckets.compact(NUM_MESSAGES_KEY)
+        _log.info('cron compacted num messages sharding counters')
 
     def _flush_channels(self):
         """Flush stale channels.
@@ -104,27 +136,70 @@ class CronDispatch(base.WebHandler):
         channels.Channel.flush()
         _log.info('cron flushed stale channels')
 
-    def _flush_memcache(self):
-        """Flush memcache.
+    def _reconcile_memcache(self):
+        """Reconcile memcache with the datastore.
 
         Social Butterfly uses memcache all over the place in order to improve
         performance.  However, a memcached item can be evicted or become
-        inconsistent at any moment.  Therefore, cron periodically flushes all
-        memcached items in order to:
-
-            1.  Test our code and ensure that it continues to function properly
-                even if nothing is memcached.  (After a flush, our code should
-                recompute and re-memcache everything.)
-
-            2.  Resolve inconsistencies between memcached and datastored values
-                by forcing recomputation of all memcached items.
+        inconsistent at any moment.  We used to flush all of memcache every
+        night, to resolve inconsistencies (at the cost of every request after
+        the flush stampeding the datastore).  Instead, periodically, cron sends
+        a request to call this method to recompute the memcached values that
+        we rely on, compare them with what memcache holds, and correct only
+        the ones that have drifted.
         """
-        _log.info('cron flushing memcache')
-        success = memcache.flush_all()
-        if success:
-            _log.info('cron flushed memcache')
-        else:
-            _log.error("cron couldn't flush memcache (RPC or server error)")
+        _log.info('cron reconciling memcache')
+        names = [NUM_USERS_KEY, NUM_ACTIVE_USERS_KEY,
+                 shards.TimeBuckets.name(NUM_MESSAGES_KEY)]
+
+        # Each of these scans can take longer than one request, so each runs
+        # in its own deferred tasks, which checkpoint their own progress.
+        deferred.defer(shards.Shard.reconcile_memcache, names)
+        deferred.defer(registry.ActiveUsers.reconcile)
+        deferred.defer(strangers.Routes.reconcile)
+        _log.info('cron deferred reconciling memcache')
+
+    def _backfill_buckets(self):
+        """Store the active users registry bucket of every active account.
+
+        We rebuild the registry one bucket at a time, by querying for each
+        bucket's active users.  Accounts put before we stored their buckets
+        don't show up in those queries until they're put again.  So
+        periodically, cron sends a request to call this method to backfill
+        their buckets.
+        """
+        _log.info('cron backfilling account buckets')
+        models.Account.backfill_buckets()
+        _log.info('cron backfilled (first batch of) account buckets')
+
+    def _rebuild_waiting_queue(self):
+        """Rebuild the queue of users waiting for a chat partner.
+
+        We pair users from a memcached waiting queue rather than by querying
+        the datastore.  But memcached values can go missing, and the queue can
+        drift from the datastore (for example, if a user's memcached slot is
+        evicted).  So periodically, cron sends a request to call this method to
+        rebuild the queue from the datastore.
+        """
+        _log.info('cron rebuilding waiting queue')
+        strangers.WaitingQueue.rebuild()
+        _log.info('cron rebuilt waiting queue')
+
+    def _reconcile_user_counts(self):
+        """Reconcile the number of users and active users.
+
+        We maintain these counts as sharding counters, updated (by
+        transactional tasks) whenever someone signs up or becomes available or
+        unavailable for chat.  So we never have to count users to serve our
+        stats.  But just in case a counter drifts, periodically, cron sends a
+        request to call this method to recount the users and correct the
+        counters.
+        """
+        _log.info('cron reconciling user counts')
+        drifts = models.Account.reconcile_counts()
+        for name, drift in drifts.items():
+            _log.info('%s looks drifted by %s; rechecking' % (name, drift))
+        _log.info('cron reconciled user counts')
 
     def _send_presence(self):
         """Send our Google Talk presence to all active users.
@@ -144,8 +219,31 @@ class Warmup(base.WebHandler):
     """Request handler to deal with warmup requests."""
 
     def get(self):
-        """ """
+        """Warm up a new instance.
+
+        The first instance of each newly deployed version also kicks off the
+        one-off jobs that a deploy needs.  (Each job's task is named after the
+        version, so it only runs once per deploy.)  In particular, right after
+        we first deploy the user counters, they haven't counted anyone yet, so
+        recount the users rather than wait for the nightly reconciliation.
+        And backfill the registry buckets of accounts put before we stored
+        them, rather than wait for the weekly backfill.
+        """
         _log.info('warmup request')
+        version = os.environ.get('CURRENT_VERSION_ID', '').replace('.', '-')
+        jobs = (
+            ('reconcile-user-counts', models.Account.reconcile_counts),
+            ('backfill-buckets', models.Account.backfill_buckets),
+        )
+        for name, func in jobs:
+            task_name = '%s-%s' % (name, version)
+            try:
+                deferred.defer(func, _name=task_name)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                _log.debug('task %s already deferred' % task_name)
+            else:
+                _log.info('deferred task %s' % task_name)
 
 
 class Connected(base.WebHandler):
@@ -155,6 +253,7 @@ class Connected(base.WebHandler):
         """A channel has connected and can receive messages."""
         client_id = self.request.get('from')
         _log.info('channel %s has connected' % client_id)
+        channels.Channel.connect(client_id)
 
 
 class Disconnected(base.WebHandler):
@@ -260,15 +359,16 @@ class Chat(base.ChatHandler):
         if alice.started:
             notifications.Notifications.already_started(alice)
         else:
-            alice.started = True
-            alice.available = True
-            alice.partners = [alice.key()]
-            alice, bob, async = strangers.Strangers.start_chat(alice)
+            def update(alice):
+                alice.started = True
+                alice.available = True
+                alice.clear_blacklist()
+            alice, bob = strangers.Strangers.start_chat(alice, update=update,
+                                                        active_delta=1)
 
             # Notify Alice and Bob.
             notifications.Notifications.started(alice)
             notifications.Notifications.chatting(bob)
-            async.get_result()
             self.update_stat(NUM_ACTIVE_USERS_KEY, 1)
             self.broadcast_stats()
             self.update_active_users(alice)
@@ -290,9 +390,8 @@ class Chat(base.ChatHandler):
             # partner in order to type /next to chat with a different partner.
             notifications.Notifications.not_chatting(alice)
         else:
-            alice, bob, async = strangers.Strangers.stop_chat(alice)
-            async.get_result()
-            alice, carol, async = strangers.Strangers.start_chat(alice)
+            alice, bob = strangers.Strangers.stop_chat(alice)
+            alice, carol = strangers.Strangers.start_chat(alice)
             if bob is None:
                 bob, dave = None, None
             elif bob == alice:
@@ -302,8 +401,7 @@ class Chat(base.ChatHandler):
             elif bob == carol:
                 bob, dave = carol, alice
             else:
-                async.get_result()
-                bob, dave, async = strangers.Strangers.start_chat(bob)
+                bob, dave = strangers.Strangers.start_chat(bob)
 
             # Notify Alice, Bob, Carol, and Dave.
             notifications.Notifications.nexted(alice)
@@ -313,7 +411,6 @@ class Chat(base.ChatHandler):
                 notifications.Notifications.chatting(carol)
             if dave not in (alice, bob, carol):
                 notifications.Notifications.chatting(dave)
-            async.get_result()
 
     @base.ChatHandler.require_account
     def stop_command(self, message=None):
@@ -323,13 +420,15 @@ class Chat(base.ChatHandler):
         if not alice.started:
             notifications.Notifications.already_stopped(alice)
         else:
-            alice.started = False
-            alice, bob, async = strangers.Strangers.stop_chat(alice)
+            active_delta = -1 if alice.available else 0
+            def update(alice):
+                alice.started = False
+            alice, bob = strangers.Strangers.stop_chat(alice, update=update,
+                                                       active_delta=active_delta)
             if bob is None:
                 carol = None
             else:
-                async.get_result()
-                bob, carol, async = strangers.Strangers.start_chat(bob)
+                bob, carol = strangers.Strangers.start_chat(bob)
 
             # Notify Alice, Bob, and Carol.
             notifications.Notifications.stopped(alice)
@@ -337,8 +436,8 @@ class Chat(base.ChatHandler):
                 notifications.Notifications.been_nexted(bob)
             if carol not in (alice, bob):
                 notifications.Notifications.chatting(carol)
-            async.get_result()
-            self.update_stat(NUM_ACTIVE_USERS_KEY, -1)
+            if active_delta:
+                self.update_stat(NUM_ACTIVE_USERS_KEY, active_delta)
             self.broadcast_stats()
             self.update_active_users(alice)
             self.send_presence_to_all()
@@ -351,6 +450,18 @@ class Chat(base.ChatHandler):
         _log.info('%s typed /who' % alice)
         notifications.Notifications.who(alice)
 
+    @base.ChatHandler.require_account
+    @base.ChatHandler.require_admin
+    def shards_command(self, message=None):
+        """Alice has typed /shards.  Tell her how contended our counters are."""
+        alice = self.get_account(message)
+        _log.info('%s typed /shards' % alice)
+        reports = []
+        for name in (shards.TimeBuckets.name(NUM_MESSAGES_KEY),):
+            num_shards, collisions, history = shards.Shard.contention(name)
+            reports.append((name, num_shards, collisions, history))
+        notifications.Notifications.shards(alice, reports)
+
     def me_command(self, message=None):
         """Alice has typed /me.  Relay her /me action to her chat partner."""
         self._common_message(message=message, me=True)
@@ -359,34 +470,51 @@ class Chat(base.ChatHandler):
         """Alice has typed a message.  Relay it to her chat partner, Bob."""
         self._common_message(message=message, me=False)
 
-    @base.ChatHandler.require_account
     def _common_message(self, message=None, me=True):
         """Alice has typed a /me command or a message to her partner.
 
-        Relay Alice's /me command or message to her chat partner, Bob.
+        Relay Alice's /me command or message to her chat partner, Bob.  In the
+        common case, Alice's route to Bob is memcached, so we can relay her
+        message without touching the datastore.
         """
+        alice = self.get_handle(message)
+        bob = strangers.Routes.get(alice)
+        if bob is None:
+            _log.debug("%s's route not memcached; checking datastore" % alice)
+            self._common_message_from_datastore(message=message, me=me)
+        else:
+            self._relay_message(alice, bob, message, me)
+
+    @base.ChatHandler.require_account
+    def _common_message_from_datastore(self, message=None, me=True):
+        """Alice's route to Bob isn't memcached.  Look up Bob in the datastore."""
         alice = self.get_account(message)
         verb = '/me' if me else 'IM'
         _log.info('%s typed %s' % (alice, verb))
         if not alice.started:
             notifications.Notifications.not_started(alice)
         else:
-            bob = alice.partner
+            # We link and unlink chat partners transactionally, so if Alice
+            # thinks that her chat partner is Bob, then Bob thinks that his
+            # chat partner is Alice.  There's no need to fetch Bob's account to
+            # double check.
+            bob = alice.partner_handle()
             if bob is None:
                 notifications.Notifications.not_chatting(alice)
             else:
-                deliverable = strangers.Strangers.is_deliverable(alice)
-                if not deliverable:
-                    _log.info("can't send %s's %s to %s" % (alice, verb, bob))
-                    notifications.Notifications.undeliverable(alice)
-                else:
-                    _log.info("sending %s's %s to %s" % (alice, verb, bob))
-                    method_name = 'me' if me else 'message'
-                    method = getattr(notifications.Notifications, method_name)
-                    method(bob, message.body)
-                    shards.Shard.increment(NUM_MESSAGES_KEY, defer=True)
-                    self.broadcast_stats()
-                    _log.info("sent %s's %s to %s" % (alice, verb, bob))
+                strangers.Routes.add(alice, bob)
+                self._relay_message(alice, bob, message, me)
+
+    def _relay_message(self, alice, bob, message, me):
+        """Relay Alice's /me command or message to her chat partner, Bob."""
+        verb = '/me' if me else 'IM'
+        _log.info("sending %s's %s to %s" % (alice, verb, bob))
+        method_name = 'me' if me else 'message'
+        method = getattr(notifications.Notifications, method_name)
+        method(bob, message.body)
+        shards.TimeBuckets.increment(NUM_MESSAGES_KEY, buffer=True)
+        self.broadcast_stats()
+        _log.info("sent %s's %s to %s" % (alice, verb, bob))
 
 
 class Error(base.WebHandler):
@@ -415,8 +543,8 @@ class Available(availability.AvailabilityHandler):
         """
         alice, made_available = self.make_available(True)
         if made_available:
-            alice.partners = [alice.key()]
-            alice, bob, async = strangers.Strangers.start_chat(alice)
+            update = lambda alice: alice.clear_blacklist()
+            alice, bob = strangers.Strangers.start_chat(alice, update=update)
             if bob is None:
                 _log.info('%s became available; looking for partner' % alice)
             else:
@@ -424,7 +552,6 @@ class Available(availability.AvailabilityHandler):
                 _log.info(body)
                 notifications.Notifications.chatting(alice)
                 notifications.Notifications.chatting(bob)
-            async.get_result()
             self.update_stat(NUM_ACTIVE_USERS_KEY, 1)
             self.broadcast_stats()
             self.update_active_users(alice)
@@ -442,21 +569,19 @@ class Unavailable(availability.AvailabilityHandler):
         """
         alice, made_unavailable = self.make_available(False)
         if made_unavailable:
-            alice, bob, async = strangers.Strangers.stop_chat(alice)
+            alice, bob = strangers.Strangers.stop_chat(alice)
             if bob is None:
                 _log.info('%s became unavailable; had no partner' % alice)
             else:
                 body = '%s became unavailable; had partner %s' % (alice, bob)
                 _log.info(body)
-                async.get_result()
-                bob, carol, async = strangers.Strangers.start_chat(bob)
+                bob, carol = strangers.Strangers.start_chat(bob)
                 if carol is None:
                     _log.info('looking for new partner for %s' % bob)
                 else:
                     _log.info('found new partner for %s: %s' % (bob, carol))
                 notifications.Notifications.been_nexted(bob)
                 notifications.Notifications.chatting(carol)
-            async.get_result()
             self.update_stat(NUM_ACTIVE_USERS_KEY, -1)
             self.broadcast_stats()
             self.update_active_users(alice)
@@ -137,7 +137,7 @@ class _Album(_HashBangHandler):
             stats = self.get_stats()
         self._respond(locals())
 
-    @base.BaseHandler.memoize(24 * 60 * 60)
+    @base.BaseHandler.memoize(24 * 60 * 60, background=True)
     def _render_album_javascript(self):
         """ """
         path = os.path.join(TEMPLATES, 'album_javascript.html')
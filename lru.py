@@ -0,0 +1,160 @@
+#-----------------------------------------------------------------------------#
+#   lru.py                                                                    #
+#                                                                             #
+#   Copyright (c) 2010-2012, Code A La Mode, original authors.                #
+#                                                                             #
+#       This file is part of Social Butterfly.                                #
+#                                                                             #
+#       Social Butterfly is free software; you can redistribute it and/or     #
+#       modify it under the terms of the GNU General Public License as        #
+#       published by the Free Software Foundation, either version 3 of the    #
+#       License, or (at your option) any later version.                       #
+#                                                                             #
+#       Social Butterfly is distributed in the hope that it will be useful,   #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#       GNU General Public License for more details.                          #
+#                                                                             #
+#       You should have received a copy of the GNU General Public License     #
+#       along with Social Butterfly.  If not, see:                            #
+#           <http://www.gnu.org/licenses/>.                                   #
+#-----------------------------------------------------------------------------#
+"""Instance-local least recently used (LRU) caches, in front of memcache.
+
+Even a memcache hit costs an RPC.  For values that we read constantly but that
+rarely change (such as sharding counter configurations), we keep a small cache
+in each instance's memory, with a size limit and a TTL per entry, so that most
+reads cost no RPC at all.  But every instance has its own caches, so an entry
+can be up to its TTL stale compared with memcache.
+"""
+
+
+import logging
+import threading
+import time
+
+from config import LRU_REPORT_EVERY
+
+
+_log = logging.getLogger(__name__)
+
+
+# Each entry is a list: [previous entry, next entry, key, value, expiry].
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRY = range(5)
+
+
+class LRUCache(object):
+    """Instance-local LRU cache with a size limit and a TTL per entry.
+
+    We keep the entries in a dict (for lookups) and in a circular doubly
+    linked list, from least to most recently used (for evictions).
+    """
+
+    def __init__(self, name, max_size, ttl):
+        """Create an empty cache of up to max_size entries, each of which
+        expires ttl seconds after it's set (by default).
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value cached for the given key, or default."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and entry[_EXPIRY] <= time.time():
+                self._unlink(entry)
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                value = default
+            else:
+                self.hits += 1
+                self._unlink(entry)
+                self._append(entry)
+                value = entry[_VALUE]
+            lookups = self.hits + self.misses
+        finally:
+            self._lock.release()
+        if lookups % LRU_REPORT_EVERY == 0:
+            self.report()
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Cache the value for the given key, for ttl seconds (by default, the
+        cache's TTL).
+
+        If the cache is full, then evict its least recently used entry.
+        """
+        expiry = time.time() + (self.ttl if ttl is None else ttl)
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            elif len(self._entries) >= self.max_size:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._entries[oldest[_KEY]]
+                self.evictions += 1
+            entry = [None, None, key, value, expiry]
+            self._entries[key] = entry
+            self._append(entry)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key=None):
+        """Forget the value cached for the given key (or if no key is given,
+        forget every value).
+        """
+        self._lock.acquire()
+        try:
+            if key is None:
+                self._entries.clear()
+                self._root[:] = [self._root, self._root, None, None, None]
+            else:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._unlink(entry)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Return a dict of the cache's size and hit rate counters."""
+        lookups = self.hits + self.misses
+        hit_rate = float(self.hits) / lookups if lookups else 0.0
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': hit_rate,
+        }
+
+    def report(self):
+        """Log the cache's size and hit rate counters."""
+        stats = self.stats()
+        body = '%s cache: %s entries, %s hits, %s misses (%.1f%% hit rate), '
+        body += '%s evictions'
+        _log.info(body % (self.name, stats['size'], stats['hits'],
+                          stats['misses'], 100 * stats['hit_rate'],
+                          stats['evictions']))
+
+    def _append(self, entry):
+        """Link an entry in as the most recently used."""
+        last = self._root[_PREV]
+        entry[_PREV], entry[_NEXT] = last, self._root
+        last[_NEXT] = self._root[_PREV] = entry
+
+    @staticmethod
+    def _unlink(entry):
+        """Unlink an entry from the list."""
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
@@ -72,6 +72,7 @@ def main():
 
         ('/cron/(.*)',                              handlers.CronDispatch),         # Web cron dispatch handler.
         ('/token',                                  handlers.Token),                # Web channel token AJAX handler.
+        ('/stats',                                  handlers.Stats),                # Web stats snapshot AJAX handler.
         ('/',                                       hashbang.HashBangDispatch),     # Web hash-bang dispatch handler.
         ('(.*)',                                    handlers.NotFound),             # Web 404: Not Found handler.
     )
@@ -22,17 +22,39 @@
 """Google App Engine datastore models."""
 
 
+import hashlib
 import logging
+import struct
 
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
+from config import ACTIVE_USERS_BUCKETS, MAX_BLACKLIST_LEN
+from config import RECONCILE_BATCH_SIZE, RECONCILE_SETTLE_SECS
+from config import NUM_USERS_KEY, NUM_ACTIVE_USERS_KEY
 from config import MIN_GMAIL_ADDR_LEN, MAX_GMAIL_ADDR_LEN
 from config import VALID_GMAIL_CHARS, VALID_GMAIL_DOMAINS
+import shards
 
 
 _log = logging.getLogger(__name__)
 
 
+class _BucketProperty(db.IntegerProperty):
+    """Datastore property for the index of the active users registry bucket
+    that an account belongs in.
+
+    The index is computed from the account's key name whenever the account is
+    put (however it's put), so it can never drift from the account's handle.
+    Indexing it lets us query for just one bucket's users.
+    """
+
+    def get_value_for_datastore(self, model_instance):
+        """ """
+        handle = Account.key_to_handle(model_instance.key().name())
+        return Account.handle_to_bucket(handle)
+
+
 class Account(db.Model):
     """ """
 
@@ -40,9 +62,10 @@ class Account(db.Model):
     started = db.BooleanProperty(required=True)
     available = db.BooleanProperty(required=True)
     partner = db.SelfReferenceProperty()
-    partners = db.ListProperty(db.Key, default=[], required=True, indexed=False)
+    blacklist = db.ListProperty(int, default=[], required=True, indexed=False)
     datetime = db.DateTimeProperty(auto_now=True, required=True)
     subscribed = db.DateTimeProperty(indexed=False)
+    bucket = _BucketProperty()
 
     def __str__(self):
         """ """
@@ -56,6 +79,49 @@ class Account(db.Model):
         """ """
         return str(self) != str(other)
 
+    def partner_handle(self):
+        """Return this user's chat partner's IM handle address, or None.
+
+        We link and unlink chat partners transactionally, so we can trust this
+        user's pointer to his/her partner without fetching the partner's
+        account.
+        """
+        key = Account.partner.get_value_for_datastore(self)
+        if key is not None:
+            return self.key_to_handle(key.name())
+
+    @staticmethod
+    def _digest(key):
+        """Hash an account key into a compact 64-bit blacklist entry.
+
+        We store 8 byte digests rather than full datastore keys so that a
+        blacklist stays small no matter how long the handles in it are.  Two
+        handles might hash to the same digest, but the odds are negligible, and
+        the worst case is that we don't pair two strangers who could've chatted.
+        """
+        digest = hashlib.md5(key.name()).digest()[:8]
+        return struct.unpack('>q', digest)[0]
+
+    def clear_blacklist(self):
+        """Forget everyone in this user's blacklist."""
+        self.blacklist = []
+
+    def add_to_blacklist(self, key):
+        """Add the account with the given key to this user's blacklist.
+
+        The blacklist is capped at MAX_BLACKLIST_LEN entries, so that no matter
+        how many times this user types /next, his/her entity doesn't grow (and
+        checking the blacklist doesn't get slower).
+        """
+        digest = self._digest(key)
+        if digest not in self.blacklist:
+            self.blacklist.append(digest)
+            self.blacklist = self.blacklist[-MAX_BLACKLIST_LEN:]
+
+    def has_blacklisted(self, key):
+        """Return whether the account with the given key is blacklisted."""
+        return self._digest(key) in self.blacklist
+
     @staticmethod
     def handle_to_key(handle):
         """Convert an IM handle address into an account key name."""
@@ -68,6 +134,47 @@ class Account(db.Model):
         handle = key_name[len('_account'):]
         return handle
 
+    @staticmethod
+    def handle_to_bucket(handle):
+        """Compute the index of the active users registry bucket that the given
+        IM handle address belongs in."""
+        digest = hashlib.md5(str(handle)).hexdigest()
+        return int(digest[:8], 16) % ACTIVE_USERS_BUCKETS
+
+    @classmethod
+    def backfill_buckets(cls, cursor=None, num_backfilled=0):
+        """Store the registry bucket of every active account put before we
+        stored buckets.
+
+        Until an account is put again, it doesn't have its bucket stored, so
+        it doesn't show up when we query for its bucket's users.  Only active
+        users belong in the registry, so we only backfill active accounts, a
+        batch at a time, each in its own transaction (so that we don't clobber
+        concurrent changes), and defer the next batch.  If a pass over all of
+        the active accounts backfilled any, then an hour later, we make
+        another pass, until one backfills none.
+        """
+        carols = cls.get_users(keys_only=False, started=True, available=True)
+        if cursor is not None:
+            carols = carols.with_cursor(cursor)
+        batch = carols.fetch(RECONCILE_BATCH_SIZE)
+
+        def txn(key):
+            carol = cls.get(key)
+            if carol is not None:
+                carol.put()
+        for carol in batch:
+            if carol.bucket is None:
+                db.run_in_transaction(txn, carol.key())
+                num_backfilled += 1
+        _log.info('backfilled buckets for %s accounts so far' % num_backfilled)
+
+        if len(batch) == RECONCILE_BATCH_SIZE:
+            deferred.defer(cls.backfill_buckets, cursor=carols.cursor(),
+                           num_backfilled=num_backfilled)
+        elif num_backfilled:
+            deferred.defer(cls.backfill_buckets, _countdown=60 * 60)
+
     @classmethod
     def factory(cls, handle):
         """A user has signed up.  Create his/her Social Butterfly account."""
@@ -88,6 +195,7 @@ class Account(db.Model):
                 account = cls(key_name=key_name, handle=handle, started=False,
                               available=False)
                 account.put()
+                shards.Shard.defer_increment(NUM_USERS_KEY, transactional=True)
                 created = True
                 _log.info('created account %s' % account)
             return account, created
@@ -160,9 +268,25 @@ class Account(db.Model):
             carols = carols.order('datetime' if order else '-datetime')
         return carols
 
+    @staticmethod
+    def count_active(delta):
+        """Alice has become active (started and available) or inactive.
+
+        Call this within the transaction that puts Alice's account, with delta
+        1 if she became active or -1 if she became inactive.  Then the number of
+        active users is updated if and only if Alice's account is.
+        """
+        if delta:
+            shards.Shard.defer_increment(NUM_ACTIVE_USERS_KEY, delta=delta,
+                                         transactional=True)
+
     @classmethod
     def _count_users(cls, started=None, available=None, chatting=None):
-        """ """
+        """Count users by paging through the datastore.
+
+        This is O(users), so only the reconcile-user-counts cron job should
+        call this.
+        """
         num_carols = 0
         carols = cls.get_users(started=started, available=available,
                                chatting=chatting)
@@ -177,9 +301,47 @@ class Account(db.Model):
     @classmethod
     def num_users(cls):
         """Return the total number of users."""
-        return cls._count_users()
+        return shards.Shard.get_count(NUM_USERS_KEY) or 0
 
     @classmethod
     def num_active_users(cls):
         """Return the number of started and available users."""
-        return cls._count_users(started=True, available=True)
+        return shards.Shard.get_count(NUM_ACTIVE_USERS_KEY) or 0
+
+    @classmethod
+    def reconcile_counts(cls, suspects=None):
+        """Recount the users, and correct our counters if they've drifted.
+
+        Increments that are still queued (in transactional tasks) make a
+        counter look drifted for a moment.  So on the first pass, we only note
+        which counters look drifted (and by how much), and defer a second pass
+        to run RECONCILE_SETTLE_SECS later.  The second pass recounts those
+        counters, and only corrects the ones that still look drifted by the
+        same amount.  Return a dict mapping the name of each counter that looked
+        drifted (or on the second pass, that we corrected) to its drift.
+        """
+        filters = {
+            NUM_USERS_KEY: {},
+            NUM_ACTIVE_USERS_KEY: {'started': True, 'available': True},
+        }
+        names = filters.keys() if suspects is None else suspects.keys()
+        drifts = {}
+        for name in names:
+            drift = shards.Shard.drift(name, cls._count_users(**filters[name]))
+            if drift:
+                drifts[name] = drift
+
+        if suspects is None:
+            if drifts:
+                _log.info('%s counters look drifted; rechecking' % len(drifts))
+                deferred.defer(cls.reconcile_counts, suspects=drifts,
+                               _countdown=RECONCILE_SETTLE_SECS)
+            return drifts
+
+        corrected = {}
+        for name, drift in drifts.items():
+            if suspects.get(name) == drift:
+                shards.Shard.correct(name, drift)
+                corrected[name] = drift
+        _log.info('corrected %s drifted counters' % len(corrected))
+        return corrected
@@ -26,8 +26,12 @@ import functools
 import logging
 import string
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import xmpp
+from google.appengine.api.xmpp import xmpp_service_pb
+from google.appengine.runtime import apiproxy_errors
 
+from config import PRESENCE_RPCS_IN_FLIGHT
 import models
 
 
@@ -213,9 +217,63 @@ class Notifications(object):
         return body
 
     @staticmethod
-    @_send_presence
-    def status(alice, stats):
+    @_send_notification
+    def shards(alice, reports):
+        """Tell Alice (an admin) how contended our sharding counters are."""
+        body = ''
+        for name, num_shards, collisions, history in reports:
+            body += '%s: %s shards, ' % (name, num_shards)
+            body += '%s recent collisions\n' % collisions
+            for entry in history:
+                body += '    %s\n' % entry
+        return body.strip()
+
+    @staticmethod
+    def _status(stats):
         """ """
         status = '%s users total, ' % stats['num_users']
         status += '%s available for chat' % stats['num_active_users']
         return status
+
+    @staticmethod
+    @_send_presence
+    def status(alice, stats):
+        """ """
+        return Notifications._status(stats)
+
+    @staticmethod
+    def status_multi(carols, stats):
+        """Send our chat status to many users, with several RPCs in flight.
+
+        xmpp.send_presence only sends to one user, and waits for its RPC to
+        complete before returning.  So instead, we make the same RPCs
+        ourselves, asynchronously, keeping up to PRESENCE_RPCS_IN_FLIGHT of
+        them in flight at once.  Return the number of users that we sent our
+        chat status to.
+        """
+        status = Notifications._status(stats)
+        rpcs = []
+        num_sent = 0
+        for carol in carols:
+            if len(rpcs) >= PRESENCE_RPCS_IN_FLIGHT:
+                num_sent += Notifications._wait_for_presence(rpcs.pop(0))
+            request = xmpp_service_pb.PresenceRequest()
+            response = xmpp_service_pb.PresenceResponse()
+            request.set_jid(str(carol))
+            request.set_status(status)
+            rpc = apiproxy_stub_map.UserRPC('xmpp')
+            rpc.make_call('SendPresence', request, response)
+            rpcs.append(rpc)
+        for rpc in rpcs:
+            num_sent += Notifications._wait_for_presence(rpc)
+        return num_sent
+
+    @staticmethod
+    def _wait_for_presence(rpc):
+        """Wait for a presence RPC to complete.  Return 1 if it succeeded."""
+        try:
+            rpc.check_success()
+        except apiproxy_errors.ApplicationError, e:
+            _log.warning("couldn't send presence (error %s)" % e.application_error)
+            return 0
+        return 1
@@ -0,0 +1,171 @@
+#-----------------------------------------------------------------------------#
+#   registry.py                                                               #
+#                                                                             #
+#   Copyright (c) 2010-2012, Code A La Mode, original authors.                #
+#                                                                             #
+#       This file is part of Social Butterfly.                                #
+#                                                                             #
+#       Social Butterfly is free software; you can redistribute it and/or     #
+#       modify it under the terms of the GNU General Public License as        #
+#       published by the Free Software Foundation, either version 3 of the    #
+#       License, or (at your option) any later version.                       #
+#                                                                             #
+#       Social Butterfly is distributed in the hope that it will be useful,   #
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of        #
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the         #
+#       GNU General Public License for more details.                          #
+#                                                                             #
+#       You should have received a copy of the GNU General Public License     #
+#       along with Social Butterfly.  If not, see:                            #
+#           <http://www.gnu.org/licenses/>.                                   #
+#-----------------------------------------------------------------------------#
+"""Memcached registry of the users who are currently active (available for chat).
+
+We used to memcache every active user's handle in one pickled set.  Every
+update re-pickled the whole set, and past about 1MB, memcache refused to store
+it at all.  So instead, we split the registry into many small memcached sets
+(buckets), by hash of handle.
+"""
+
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+
+from config import ACTIVE_USERS_KEY, ACTIVE_USERS_BUCKETS, NUM_RETRIES
+from config import RECONCILE_BATCHES
+import models
+
+
+_log = logging.getLogger(__name__)
+
+
+class ActiveUsers(object):
+    """Public API for the memcached registry of active users' handles."""
+
+    @staticmethod
+    def bucket(handle):
+        """Compute the index of the bucket that the given handle belongs in."""
+        return models.Account.handle_to_bucket(handle)
+
+    @staticmethod
+    def _key(index):
+        """Compute the memcache key for the bucket at the given index."""
+        return '%s_%s' % (ACTIVE_USERS_KEY, index)
+
+    @classmethod
+    def update(cls, alice):
+        """Alice's account has changed.  Add her to or remove her from the registry."""
+        handle = str(alice)
+        active = alice.started and alice.available
+        key = cls._key(cls.bucket(handle))
+        client = memcache.Client()
+        for retry in range(NUM_RETRIES):
+            handles = client.gets(key)
+            if handles is None:
+                # Alice's bucket isn't memcached.  Whenever someone needs it,
+                # it'll be rebuilt from the datastore (including Alice).
+                return
+            if active:
+                handles.add(handle)
+            else:
+                handles.discard(handle)
+            if client.cas(key, handles):
+                return
+
+        # We couldn't update Alice's bucket, so we can no longer trust it.
+        # Delete it, so that it gets rebuilt from the datastore.
+        _log.warning("couldn't update %s in active users registry" % alice)
+        client.delete(key)
+
+    @classmethod
+    def get_multi(cls, indices):
+        """Return a dict mapping each given bucket index to its set of handles.
+
+        Rebuild any of the given buckets that aren't memcached.
+        """
+        keys = [cls._key(index) for index in indices]
+        memcached = memcache.get_multi(keys)
+        buckets, missing = {}, []
+        for index, key in zip(indices, keys):
+            if key in memcached:
+                buckets[index] = memcached[key]
+            else:
+                missing.append(index)
+        if missing:
+            buckets.update(cls.rebuild(missing))
+        return buckets
+
+    @classmethod
+    def get(cls, index):
+        """Return the set of handles in the bucket at the given index."""
+        return cls.get_multi([index])[index]
+
+    @staticmethod
+    def _scan(indices):
+        """Compute the buckets at the given indices from the datastore.
+
+        Every account stores (and indexes) its bucket, so we query for just the
+        active users in each of the buckets that we're computing.  Return a
+        dict mapping each given bucket index to its set of handles.
+        """
+        buckets = {}
+        for index in indices:
+            carols = models.Account.get_users(started=True, available=True)
+            carols = carols.filter('bucket =', index)
+            buckets[index] = set([models.Account.key_to_handle(carol.name())
+                                  for carol in carols])
+        return buckets
+
+    @classmethod
+    def rebuild(cls, indices):
+        """Rebuild the buckets at the given indices from the datastore.
+
+        Return a dict mapping each given bucket index to its set of handles.
+        """
+        _log.info('rebuilding %s active users registry buckets' % len(indices))
+        buckets = cls._scan(indices)
+
+        # Use add rather than set, so that we don't clobber a bucket that
+        # someone else rebuilt (and maybe updated) while we were scanning.
+        mapping = dict([(cls._key(index), handles)
+                        for index, handles in buckets.items()])
+        memcache.add_multi(mapping)
+        _log.info('rebuilt %s active users registry buckets' % len(indices))
+        return buckets
+
+    @classmethod
+    def reconcile(cls, start=0, num_drifted=0):
+        """Correct memcached buckets that have drifted from the datastore.
+
+        We check RECONCILE_BATCHES buckets at a time, starting from the bucket
+        at index start, then defer the rest.  We read the memcached buckets
+        before we query the datastore, and only correct a bucket if no one has
+        updated it since we read it.  Return the number of handles (so far)
+        that were missing from or extra in their buckets.
+        """
+        stop = min(start + RECONCILE_BATCHES, ACTIVE_USERS_BUCKETS)
+        indices = range(start, stop)
+        keys = [cls._key(index) for index in indices]
+        client = memcache.Client()
+        memcached = client.get_multi(keys, for_cas=True)
+        buckets = cls._scan(indices)
+
+        num_corrected = 0
+        for index, key in zip(indices, keys):
+            if not memcached.has_key(key):
+                continue
+            drifted = len(memcached[key].symmetric_difference(buckets[index]))
+            if drifted:
+                num_drifted += drifted
+                if client.cas(key, buckets[index]):
+                    num_corrected += 1
+        body = 'corrected %s active users registry buckets (%s to %s)'
+        _log.info(body % (num_corrected, start, stop - 1))
+
+        if stop < ACTIVE_USERS_BUCKETS:
+            deferred.defer(cls.reconcile, start=stop, num_drifted=num_drifted)
+        else:
+            _log.info('%s active users registry handles drifted' % num_drifted)
+        return num_drifted
@@ -27,6 +27,7 @@ For more information, see:
 """
 
 
+import datetime
 import logging
 import random
 
@@ -34,7 +35,17 @@ from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
-from config import DEFAULT_NUM_SHARDS, NUM_RETRIES
+from config import DEFAULT_NUM_SHARDS, NUM_RETRIES, SHARD_FLUSH_INTERVAL
+from config import SHARD_ROLLUP_INTERVAL
+from config import MEMCACHE_COUNTER_SHARDS
+from config import MAX_NUM_SHARDS
+from config import TIME_BUCKET_COMPACT_DAYS, TIME_BUCKET_DST
+from config import TIME_BUCKET_UTC_OFFSET
+from config import SHARD_CONTENTION_THRESHOLD, SHARD_CONTENTION_WINDOW
+from config import RECONCILE_SETTLE_SECS
+from config import SHARD_CONFIG_LRU_SIZE, SHARD_CONFIG_LRU_TTL
+import coalescing
+import lru
 
 
 _log = logging.getLogger(__name__)
@@ -45,29 +56,93 @@ class _ShardConfig(db.Model):
 
     num_shards = db.IntegerProperty(default=DEFAULT_NUM_SHARDS, required=True, indexed=False)
     datetime = db.DateTimeProperty(required=True, indexed=False, auto_now_add=True)
+    history = db.StringListProperty(default=[], required=True, indexed=False)
+
+    # Every counter increment reads its counter's configuration, so keep
+    # configurations cached in this instance's memory, in front of memcache.
+    _cache = lru.LRUCache('shard configs', SHARD_CONFIG_LRU_SIZE,
+                         SHARD_CONFIG_LRU_TTL)
 
     @classmethod
     def memcache_get_or_insert(cls, name):
         """ """
         key_name = name + '_config'
-        config = memcache.get(key_name)
+        config = cls._cache.get(key_name)
         if config is None:
-            config = cls.get_or_insert(key_name)
-            memcache.add(key_name, config)
+            config = memcache.get(key_name)
+            if config is None:
+                config = cls.get_or_insert(key_name)
+                memcache.add(key_name, config)
+            cls._cache.set(key_name, config)
         return config
 
     @classmethod
     def memcache_get(cls, name):
         """ """
         key_name = name + '_config'
-        config = memcache.get(key_name)
+        config = cls._cache.get(key_name)
         if config is None:
-            config = cls.get_by_key_name(key_name)
+            config = memcache.get(key_name)
+            if config is None:
+                config = cls.get_by_key_name(key_name)
+                if config is not None:
+                    memcache.add(key_name, config)
             if config is not None:
-                memcache.add(key_name, config)
+                cls._cache.set(key_name, config)
         return config
 
 
+class _ShardRollup(db.Model):
+    """Datastore model containing the total value for a named counter.
+
+    Rather than write the total on every increment (which would serialize all
+    of the counter's increments on this one entity), we recompute it from the
+    counter's shards at most once per SHARD_ROLLUP_INTERVAL seconds after the
+    counter is incremented.  Recomputing is idempotent, so it's safe to retry.
+    Once a counter is compacted, its rollup alone holds its value.
+
+    Only refreshing a rollup after an increment sets when the counter was last
+    updated; reconciling or compacting a counter leaves that alone.
+    """
+
+    count = db.IntegerProperty(required=True, default=0, indexed=False)
+    datetime = db.DateTimeProperty(required=True, indexed=False, auto_now=True)
+    updated = db.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def refresh(cls, window, name):
+        """Recompute a named counter's total from its shards, unless the
+        counter has since been compacted (and its shards deleted)."""
+        if _ShardConfig.get_by_key_name(name + '_config') is None:
+            _log.debug('not refreshing rollup for %s (compacted)' % name)
+        else:
+            cls.rebuild(name, updated=datetime.datetime.now())
+
+    @classmethod
+    def rebuild(cls, name, updated=None):
+        """Recompute the total value for a named counter from its shards.
+
+        If updated is given, then record it as when the counter was last
+        incremented.  Otherwise, keep whenever the rollup last recorded.
+        """
+        key_name = name + '_rollup'
+        if updated is None:
+            rollup = cls.get_by_key_name(key_name)
+            if rollup is not None:
+                updated = rollup.updated
+        total = 0
+        shards = Shard.all().filter('name = ', name)
+        num_shards = 0
+        for shard in shards:
+            total += shard.count
+            num_shards += 1
+        _log.debug('found %s shards for %s' % (num_shards, name))
+        rollup = cls(key_name=key_name, count=total, updated=updated)
+        rollup.put()
+        _log.info('rebuilt rollup for %s' % name)
+        return rollup
+
+
 class Shard(db.Model):
     """Datastore model for a shard for a named counter, and public API."""
 
@@ -76,22 +151,29 @@ class Shard(db.Model):
     datetime = db.DateTimeProperty(required=True, auto_now=True)
 
     @staticmethod
-    def set_num_shards(name, num):
+    def set_num_shards(name, num, reason=None):
         """Increase the number of shards for a named counter to the given num.
 
-        This method never decreases the number of shards.
+        This method never decreases the number of shards.  If a reason is
+        given, then we note the change (and the reason) in the counter's
+        history.
         """
         key_name = name + '_config'
 
         def txn():
             created = False
             updated = False
-            config = _ShardConfig.get(key_name)
+            config = _ShardConfig.get_by_key_name(key_name)
             if config is None:
                 created = True
                 config = _ShardConfig(key_name=key_name)
             if config.num_shards < num:
                 updated = True
+                if reason is not None:
+                    now = datetime.datetime.now().replace(microsecond=0)
+                    entry = '%s: %s -> %s shards (%s)'
+                    entry %= (now, config.num_shards, num, reason)
+                    config.history = (config.history + [entry])[-10:]
                 config.num_shards = num
             if created or updated:
                 config.put()
@@ -104,6 +186,49 @@ class Shard(db.Model):
             client.add(key_name, config)
         elif memcached_config.num_shards < config.num_shards:
             client.cas(key_name, config)
+        _ShardConfig._cache.invalidate(key_name)
+
+    @staticmethod
+    def carry_over(name, previous):
+        """Seed a named counter's configuration from a previous counter's (for
+        example, yesterday's bucket of a time-bucketed counter).
+
+        The counter starts with as many shards as the previous counter grew
+        to, and with its history.  If the counter already has a configuration,
+        or the previous counter doesn't, then leave it alone.
+        """
+        previous_config = _ShardConfig.memcache_get(previous)
+        if previous_config is None:
+            return
+        key_name = name + '_config'
+
+        def txn():
+            config = _ShardConfig.get_by_key_name(key_name)
+            if config is None:
+                config = _ShardConfig(key_name=key_name,
+                                      num_shards=previous_config.num_shards,
+                                      history=previous_config.history)
+                config.put()
+            return config
+        config = db.run_in_transaction(txn)
+        memcache.add(key_name, config)
+        _log.info('carried over %s shards from %s to %s' %
+                  (config.num_shards, previous, name))
+
+    @staticmethod
+    def contention(name):
+        """Report on how contended a named counter's shards are.
+
+        Return the counter's number of shards, the number of collisions in the
+        current SHARD_CONTENTION_WINDOW, and the history of times that we've
+        grown the counter's number of shards (and why).
+        """
+        config = _ShardConfig.memcache_get(name)
+        if config is None:
+            return 0, 0, []
+        window = coalescing.Coalescer.window(SHARD_CONTENTION_WINDOW)
+        collisions = memcache.get('%s_contention_%s' % (name, window))
+        return config.num_shards, collisions or 0, config.history
 
     @staticmethod
     def created(name):
@@ -118,82 +243,338 @@ class Shard(db.Model):
 
     @classmethod
     def updated(cls, name):
-        """Get the date/time when a named counter was last incremented.
+        """Get the date/time when a named counter was last incremented (to
+        within SHARD_ROLLUP_INTERVAL seconds).
 
         If a counter with the given name has not yet been incremented, this
         method (implicitly) returns None.
         """
-        shard = cls.all().filter('name = ', name).order('-datetime').get()
-        if shard is not None:
-            return shard.datetime
+        rollup = _ShardRollup.get_by_key_name(name + '_rollup')
+        if rollup is not None:
+            return rollup.updated
 
     @classmethod
     def get_count(cls, name, increment=0):
-        """Retrieve the value for a named counter."""
-        client = memcache.Client()
-        total = client.gets(name)
+        """Retrieve the value for a named counter.
+
+        On a memcache miss, read the counter's rollup with a single get by key,
+        and add the counter's buffered increments that haven't been flushed
+        yet.  (The rollup can be up to SHARD_ROLLUP_INTERVAL seconds behind the
+        counter's shards; _ShardRollup.refresh catches it up.)  If the counter
+        has never been incremented, then its value is just increment.
+        """
+        total = MemcacheCounter.get(name)
         if total is None:
             _log.debug('memcache miss when getting count for ' + name)
-            config = _ShardConfig.memcache_get(name)
-            if config is None:
-                _log.debug("couldn't find shard config for " + name)
+            rollup = _ShardRollup.get_by_key_name(name + '_rollup')
+            total = increment
+            if rollup is None:
+                _log.debug("couldn't find rollup for " + name)
             else:
-                _log.debug('found shard config for ' + name)
-                total = increment
-                shards = cls.all().filter('name = ', name)
-                num_shards = 0
-                for shard in shards:
-                    total += shard.count
-                    num_shards += 1
-                _log.debug('found %s shards for %s' % (num_shards, name))
-                client.add(name, total)
-                _log.debug('computed and memcached count for ' + name)
+                total += rollup.count + (memcache.get(name + '_buffer') or 0)
+                if MemcacheCounter.add(name, total):
+                    _log.debug('computed and memcached count for ' + name)
+                else:
+                    # Someone else memcached the counter first.  Their value
+                    # doesn't include our increment, so add it to theirs.
+                    if increment:
+                        MemcacheCounter.incr(name, delta=increment)
+                    memcached = MemcacheCounter.get(name)
+                    if memcached is not None:
+                        total = memcached
         else:
             _log.debug('memcache hit when getting count for ' + name)
             if increment:
                 total += increment
-                client.cas(name, total)
+                MemcacheCounter.incr(name, delta=increment)
         return total
 
     @classmethod
-    def increment(cls, name, defer=False):
-        """Increment the memcached total value for a named counter."""
-        if memcache.incr(name) is None:
+    def get_count_multi(cls, names):
+        """Retrieve the values for several named counters.
+
+        Return a dict mapping each name to its value.  For the counters that
+        aren't memcached, fall back to their rollups (plus their unflushed
+        buffers), all in one datastore get and one memcache get.
+        """
+        totals = MemcacheCounter.get_multi(names)
+        missed = [name for name in names if not totals.has_key(name)]
+        if missed:
+            _log.debug('memcache miss when getting counts for %s' % missed)
+            rollups = _ShardRollup.get_by_key_name([name + '_rollup'
+                                                    for name in missed])
+            buffers = memcache.get_multi([name + '_buffer' for name in missed])
+            computed = {}
+            for name, rollup in zip(missed, rollups):
+                totals[name] = 0
+                if rollup is not None:
+                    buffered = buffers.get(name + '_buffer') or 0
+                    computed[name] = rollup.count + buffered
+            totals.update(computed)
+            lost = MemcacheCounter.add_multi(computed)
+            if lost:
+                totals.update(MemcacheCounter.get_multi(lost))
+        return totals
+
+    @classmethod
+    def increment(cls, name, defer=False, buffer=False):
+        """Increment the memcached total value for a named counter.
+
+        Also increment one of the counter's datastored shards: right away by
+        default, in a deferred task if defer, or (if buffer) in a batch along
+        with every other buffered increment in the next SHARD_FLUSH_INTERVAL
+        seconds.  Buffering turns N increments into one task and one datastore
+        transaction per interval, at the risk of losing up to an interval's
+        worth of increments if memcache evicts the buffer before it's flushed.
+        """
+        if MemcacheCounter.incr(name) is None:
             cls.get_count(name, increment=1)
-        if defer:
+        if buffer:
+            memcache.incr(name + '_buffer', initial_value=0)
+            coalescing.Coalescer.defer(name + '_flush', SHARD_FLUSH_INTERVAL,
+                                       cls._flush, name)
+        elif defer:
             deferred.defer(cls._increment, name)
         else:
             cls._increment(name)
 
     @classmethod
-    def _increment(cls, name):
-        """Increment the memcached and datastored values for a shard."""
+    def defer_increment(cls, name, delta=1, transactional=False):
+        """Add delta (which may be negative) to a named counter's datastored
+        shards, in a deferred task.
+
+        Leave the counter's memcached total value alone; that's up to the
+        caller.  If transactional, then the task is only enqueued if the
+        caller's current datastore transaction commits.
+        """
+        deferred.defer(cls._increment, name, delta=delta,
+                       _transactional=transactional)
+
+    @classmethod
+    def drift(cls, name, total):
+        """Return how far a named counter's datastored total has drifted from
+        the given total (freshly recomputed from the source of truth).
+
+        Increments that are still on their way to the counter's shards (in
+        deferred tasks) make a counter look drifted for a moment, so only
+        correct a counter that looks drifted by the same amount twice, a while
+        apart.
+        """
+        rollup = _ShardRollup.rebuild(name)
+        return total - rollup.count
+
+    @classmethod
+    def correct(cls, name, drift):
+        """Correct a named counter that has drifted by the given amount."""
+        _log.warning('%s drifted by %s; correcting' % (name, drift))
+        cls._increment(name, delta=drift)
+        MemcacheCounter.incr(name, delta=drift)
+
+    @classmethod
+    def memcache_drift(cls, names):
+        """Compare named counters' memcached totals with their datastored
+        totals.
+
+        Return a dict mapping the name of each counter whose totals differ to
+        its (memcached, datastored) totals.  A counter's datastored total
+        includes its buffered increments that haven't been flushed yet.
+        Leave out counters that aren't memcached (they'll be recomputed when
+        they're next read).
+        """
+        memcached = MemcacheCounter.get_multi(names)
+        names = [name for name in names if memcached.has_key(name)]
+        rollups = _ShardRollup.get_by_key_name([name + '_rollup'
+                                                for name in names])
+        buffers = memcache.get_multi([name + '_buffer' for name in names])
+        drifts = {}
+        for name, rollup in zip(names, rollups):
+            if rollup is not None:
+                datastored = rollup.count + (buffers.get(name + '_buffer') or 0)
+                if memcached[name] != datastored:
+                    drifts[name] = (memcached[name], datastored)
+        return drifts
+
+    @classmethod
+    def reconcile_memcache(cls, names, suspects=None):
+        """Correct named counters whose memcached values have drifted from
+        their datastored values.
+
+        A counter can look drifted for a moment, while an increment is on its
+        way to its shards.  So on the first pass, we only note which counters
+        look drifted (and by how much), and defer a second pass to run
+        RECONCILE_SETTLE_SECS later.  The second pass only corrects the
+        counters that still look drifted by the same amount.  Memcached shard
+        configurations are corrected right away.  Return the number of
+        counters (and configurations) that drifted.
+        """
+        num_drifted = 0
+        key_names = [name + '_config' for name in names]
+        client = memcache.Client()
+        memcached = client.get_multi(key_names)
+        configs = _ShardConfig.get_by_key_name(key_names)
+        for key_name, config in zip(key_names, configs):
+            memcached_config = memcached.get(key_name)
+            if config is not None and memcached_config is not None and \
+               memcached_config.num_shards != config.num_shards:
+                body = '%s drifted: %s memcached shards, %s datastored'
+                _log.warning(body % (key_name, memcached_config.num_shards,
+                                     config.num_shards))
+                client.set(key_name, config)
+                _ShardConfig._cache.invalidate(key_name)
+                num_drifted += 1
+
+        drifts = cls.memcache_drift(names)
+        if suspects is None:
+            if drifts:
+                _log.info('%s counters look drifted; rechecking' % len(drifts))
+                deferred.defer(cls.reconcile_memcache, drifts.keys(),
+                               suspects=drifts,
+                               _countdown=RECONCILE_SETTLE_SECS)
+            return num_drifted
+
+        for name, (memcached_total, datastored_total) in drifts.items():
+            if suspects.get(name) == (memcached_total, datastored_total):
+                body = '%s drifted: %s memcached, %s datastored'
+                _log.warning(body % (name, memcached_total, datastored_total))
+                # Correct the counter by its drift (rather than set it), so
+                # that we don't clobber increments that landed since we read
+                # it.
+                MemcacheCounter.incr(name,
+                                     delta=datastored_total - memcached_total)
+                num_drifted += 1
+        _log.info('corrected %s drifted counters' % num_drifted)
+        return num_drifted
+
+    @classmethod
+    def _flush(cls, window, name):
+        """Flush a named counter's buffered increments to its shards."""
+        key_name = name + '_buffer'
+        client = memcache.Client()
+        delta = client.get(key_name)
+        if not delta:
+            _log.debug('no buffered increments to flush for ' + name)
+            return
+
+        # Decrementing is atomic, so any increments buffered while we're
+        # flushing stay in the buffer for the next flush.
+        if client.decr(key_name, delta=delta) is None:
+            _log.warning("couldn't flush %s; buffer evicted" % name)
+            return
+
+        # Only put the increments back in the buffer if our transaction didn't
+        # commit.  (Once it has committed, nothing after it raises.)
+        committed = False
+        try:
+            committed = cls._increment(name, delta=delta)
+        finally:
+            if not committed:
+                _log.warning("couldn't flush %s; rebuffering" % name)
+                client.incr(key_name, delta=delta, initial_value=0)
+        _log.info('flushed %s buffered increments for %s' % (delta, name))
+
+        if client.get(key_name):
+            coalescing.Coalescer.defer(name + '_flush', SHARD_FLUSH_INTERVAL,
+                                       cls._flush, name)
+
+    @classmethod
+    def _increment(cls, name, delta=1):
+        """Increment the memcached and datastored values for a shard.
+
+        Return whether our transaction committed.  If it did, then this method
+        doesn't raise, so that a deferred task (or a flush) that calls it won't
+        retry (and double count) the increment.
+        """
         client = memcache.Client()
         config = _ShardConfig.memcache_get_or_insert(name)
         index = random.randint(0, config.num_shards - 1)
         key_name = name + str(index)
 
+        # Keep track of how many times our transaction collides with others.
+        contention = {'attempts': 0}
+
         def txn():
-            for retry in range(NUM_RETRIES):
-                shard = client.gets(key_name)
-                method_name = 'cas'
-                if shard is None:
-                    shard = cls.get_by_key_name(key_name)
-                    if shard is None:
-                        shard = cls(key_name=key_name, name=name)
-                    method_name = 'add'
-                shard.count += 1
-                method = getattr(client, method_name)
-                success = method(key_name, shard)
+            contention['attempts'] += 1
+            shard = cls.get_by_key_name(key_name)
+            if shard is None:
+                shard = cls(key_name=key_name, name=name)
+            shard.count += delta
+            shard.put()
+            return shard
+
+        # Only memcache the shard once our transaction has committed.  (If we
+        # memcached it within the transaction, and the transaction collided
+        # and retried, then the retry would add delta to the memcached copy
+        # again.)
+        shard = None
+        try:
+            shard = db.run_in_transaction(txn)
+        finally:
+            success = shard is not None
+            try:
+                collisions = contention['attempts'] - 1
+                cls._record_contention(name, config, collisions)
                 if success:
-                    shard.put()
-                    break
-            return success
-        success = db.run_in_transaction(txn)
+                    client.set(key_name, shard)
+                    coalescing.Coalescer.defer(name + '_rollup',
+                                               SHARD_ROLLUP_INTERVAL,
+                                               _ShardRollup.refresh, name)
+            except Exception, e:
+                _log.error("couldn't wrap up increment of %s: %s" % (name, e))
+        return success
+
+    @classmethod
+    def _record_contention(cls, name, config, collisions):
+        """Record collisions on a named counter's shards.
+
+        If there have been too many collisions lately, then grow the counter's
+        number of shards, so that its increments spread out further.
+        """
+        if collisions <= 0:
+            return
+        window = coalescing.Coalescer.window(SHARD_CONTENTION_WINDOW)
+        key_name = '%s_contention_%s' % (name, window)
+        memcache.add(key_name, 0, time=2 * SHARD_CONTENTION_WINDOW)
+        total = memcache.incr(key_name, delta=collisions)
+        _log.info('%s collisions on %s shards' % (collisions, name))
+
+        if total is not None and total >= SHARD_CONTENTION_THRESHOLD and \
+           config.num_shards < MAX_NUM_SHARDS:
+            # Only grow the counter's number of shards once per window, even if
+            # lots of increments are colliding at once.
+            if memcache.add(name + '_growing', True,
+                            time=SHARD_CONTENTION_WINDOW):
+                num = min(2 * config.num_shards, MAX_NUM_SHARDS)
+                reason = '%s collisions in %ss' % (total,
+                                                   SHARD_CONTENTION_WINDOW)
+                _log.warning('growing %s to %s shards; %s' % (name, num, reason))
+                cls.set_num_shards(name, num, reason=reason)
 
     @classmethod
     def reset(cls, name):
         """Reset to 0 the value for a named counter."""
+        cls._delete(name, keep_total=False)
+
+    @classmethod
+    def compact(cls, name):
+        """Fold a named counter's shards into its rollup, then delete them.
+
+        Once we're done incrementing a counter (say, yesterday's bucket of a
+        time-bucketed counter), its rollup alone can tell us its value, so its
+        shards and configuration are dead weight.
+        """
+        if cls.all(keys_only=True).filter('name = ', name).get() is None:
+            _log.debug('not compacting %s (no shards)' % name)
+        else:
+            _ShardRollup.rebuild(name)
+            cls._delete(name, keep_total=True)
+            _log.info('compacted %s' % name)
+
+    @classmethod
+    def _delete(cls, name, keep_total=False):
+        """Delete a named counter's shards and configuration.
+
+        Unless keep_total, also delete the counter's rollup and memcached total.
+        """
 
         # First, delete all of the datastored shards, 500 at a time.  We do 500
         # at a time because the datastore limits batch operations to 500 per
@@ -209,7 +590,7 @@ class Shard(db.Model):
             shards = shards.with_cursor(cursor)
             keys = shards.fetch(500)
 
-        # Next, delete the datastored configuration.
+        # Next, delete the datastored configuration and rollup.
         config = _ShardConfig.memcache_get(name)
         if config is None:
             num_shards = 0
@@ -217,10 +598,17 @@ class Shard(db.Model):
             num_shards = config.num_shards
             async = db.delete_async(config)
             asyncs.append(async)
+        if not keep_total:
+            rollup_key = db.Key.from_path(_ShardRollup.kind(), name + '_rollup')
+            async = db.delete_async(rollup_key)
+            asyncs.append(async)
 
         # Finally, delete the memcached count, configuration, and shards.
+        _ShardConfig._cache.invalidate(name + '_config')
         client = memcache.Client()
-        key_names = [name, name + '_config']
+        key_names = [name + '_config']
+        if not keep_total:
+            key_names.extend(MemcacheCounter.key_names(name))
         for index in range(num_shards):
             key_names.append(name + str(index))
         async = client.delete_multi_async(key_names)
@@ -228,3 +616,200 @@ class Shard(db.Model):
 
         for async in asyncs:
             async.get_result()
+
+
+class TimeBuckets(object):
+    """Public API for named counters bucketed by time.
+
+    Rather than keep one counter forever and periodically reset it, we keep a
+    separate counter per day, hour, and minute, named after the bucket.  Moving
+    on to a new day is just a matter of incrementing a differently named
+    counter, and old buckets are compacted in the background.
+
+    Day buckets are sharding counters.  Each new day's bucket starts with as
+    many shards as the previous day's bucket grew to.  Minute and hour buckets
+    are only ever used to compute rates, so they live only in memcache, and
+    expire after _TTLS seconds.
+    """
+
+    _FORMATS = {
+        'minute': '%Y%m%d%H%M',
+        'hour': '%Y%m%d%H',
+        'day': '%Y%m%d',
+    }
+
+    _DELTAS = {
+        'minute': datetime.timedelta(minutes=1),
+        'hour': datetime.timedelta(hours=1),
+        'day': datetime.timedelta(days=1),
+    }
+
+    _TTLS = {
+        'minute': 60 * 60,
+        'hour': 2 * 24 * 60 * 60,
+    }
+
+    @classmethod
+    def now(cls):
+        """Return the current date/time in our buckets' time zone.
+
+        If TIME_BUCKET_DST, then the time zone observes US daylight saving time
+        (since 2007: from 2:00 AM on the second Sunday in March until 2:00 AM on
+        the first Sunday in November, local time), the same as the
+        America/Chicago time zone that our cron jobs run in.
+        """
+        utcnow = datetime.datetime.utcnow()
+        hours = TIME_BUCKET_UTC_OFFSET
+        if TIME_BUCKET_DST:
+            start = cls._nth_sunday(utcnow.year, 3, 2) + \
+                    datetime.timedelta(hours=2 - hours)
+            end = cls._nth_sunday(utcnow.year, 11, 1) + \
+                  datetime.timedelta(hours=2 - (hours + 1))
+            if start <= utcnow < end:
+                hours += 1
+        return utcnow + datetime.timedelta(hours=hours)
+
+    @staticmethod
+    def _nth_sunday(year, month, n):
+        """Return midnight on the nth Sunday of the given month."""
+        first = datetime.datetime(year, month, 1)
+        days = (6 - first.weekday()) % 7 + 7 * (n - 1)
+        return first + datetime.timedelta(days=days)
+
+    @classmethod
+    def name(cls, name, resolution='day', when=None):
+        """Compute the name of a named counter's bucket containing when."""
+        if when is None:
+            when = cls.now()
+        return '%s_%s_%s' % (name, resolution,
+                             when.strftime(cls._FORMATS[resolution]))
+
+    @classmethod
+    def previous(cls, name, resolution='minute', ago=1):
+        """Compute the name of the bucket that ended ago buckets ago."""
+        when = cls.now() - ago * cls._DELTAS[resolution]
+        return cls.name(name, resolution=resolution, when=when)
+
+    @classmethod
+    def increment(cls, name, buffer=False):
+        """Increment the current day, hour, and minute buckets for a counter."""
+        now = cls.now()
+        day = cls.name(name, 'day', now)
+        if _ShardConfig.memcache_get(day) is None:
+            yesterday = cls.name(name, 'day', now - cls._DELTAS['day'])
+            Shard.carry_over(day, yesterday)
+        Shard.increment(day, buffer=buffer)
+
+        # offset_multi's initial_value would create the keys without an
+        # expiry, so add them (with their expiries) first.
+        key_names = []
+        for resolution in ('hour', 'minute'):
+            key_name = cls.name(name, resolution, now)
+            key_names.append(key_name)
+            memcache.add(key_name, 0, time=cls._TTLS[resolution])
+        memcache.offset_multi(dict([(key_name, 1) for key_name in key_names]),
+                              initial_value=0)
+
+    @classmethod
+    def get_count(cls, name, resolution='day', when=None):
+        """Retrieve the value of a named counter's bucket containing when."""
+        key_name = cls.name(name, resolution=resolution, when=when)
+        if resolution == 'day':
+            return Shard.get_count(key_name)
+        return memcache.get(key_name)
+
+    @classmethod
+    def compact(cls, name, days=TIME_BUCKET_COMPACT_DAYS):
+        """Compact the day buckets of a named counter from before today."""
+        for ago in range(1, days + 1):
+            Shard.compact(cls.previous(name, resolution='day', ago=ago))
+
+
+class MemcacheCounter(object):
+    """Public API for memcached counters sharded across several keys.
+
+    Incrementing a plain memcached counter always hits the same key, and so
+    the same memcache server.  Instead, we split each counter across
+    MEMCACHE_COUNTER_SHARDS keys, increment a random one, and read the counter
+    by summing all of them with one get_multi.
+
+    memcache won't decrement a value below 0, so every key holds its share of
+    the count plus a large bias, which we subtract back out when we read.  If
+    any of a counter's keys has been evicted, then we consider the whole
+    counter not memcached.
+    """
+
+    _BIAS = 2 ** 40
+
+    @staticmethod
+    def key_names(name):
+        """Compute the memcache keys that a named counter is split across."""
+        return ['%s_mc%s' % (name, index)
+                for index in range(MEMCACHE_COUNTER_SHARDS)]
+
+    @classmethod
+    def get_multi(cls, names):
+        """Return a dict of the values of the memcached named counters."""
+        key_names = []
+        for name in names:
+            key_names.extend(cls.key_names(name))
+        values = memcache.get_multi(key_names)
+
+        counters = {}
+        for name in names:
+            try:
+                total = sum([values[key_name] for key_name in cls.key_names(name)])
+            except KeyError:
+                continue
+            counters[name] = total - MEMCACHE_COUNTER_SHARDS * cls._BIAS
+        return counters
+
+    @classmethod
+    def get(cls, name):
+        """Return the value of a named counter, or None if it isn't memcached."""
+        return cls.get_multi([name]).get(name)
+
+    @classmethod
+    def add_multi(cls, mapping):
+        """Memcache the named counters in the given dict with the given values,
+        unless they're already memcached.
+
+        We use add rather than set, so that we don't clobber increments (or
+        another request's values) that landed after the caller computed its
+        values.  Return the names of the counters whose adds lost the race;
+        the caller should re-read those.
+        """
+        values, names = {}, {}
+        for name, value in mapping.items():
+            key_names = cls.key_names(name)
+            values[key_names[0]] = cls._BIAS + value
+            for key_name in key_names[1:]:
+                values[key_name] = cls._BIAS
+            for key_name in key_names:
+                names[key_name] = name
+        failed = memcache.add_multi(values)
+        lost = {}
+        for key_name in failed:
+            lost[names[key_name]] = True
+        return lost.keys()
+
+    @classmethod
+    def add(cls, name, value):
+        """Memcache a named counter with the given value, unless it's already
+        memcached.  Return whether we memcached it."""
+        return not cls.add_multi({name: value})
+
+    @classmethod
+    def incr(cls, name, delta=1):
+        """Add delta (which may be negative) to a named counter.
+
+        Return True, or None if the counter isn't memcached (in which case, the
+        caller should compute it and set it).
+        """
+        key_name = random.choice(cls.key_names(name))
+        if delta >= 0:
+            value = memcache.incr(key_name, delta=delta)
+        else:
+            value = memcache.decr(key_name, delta=-delta)
+        if value is not None:
+            return True
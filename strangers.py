@@ -22,15 +22,352 @@
 """ """
 
 
+import datetime
 import logging
+import time
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.runtime import DeadlineExceededError
 
+from config import NUM_PARTNER_CANDIDATES, NUM_RETRIES
+from config import RECONCILE_BATCH_SIZE, RECONCILE_BATCHES, ROUTES_TTL
+from config import ROUTES_KEY, WAITING_QUEUE_KEY, WAITING_QUEUE_SLOT_TIMEOUT
+import coalescing
 import models
+import notifications
 
 
 _log = logging.getLogger(__name__)
 
+# Linking or unlinking two chat partners touches both of their accounts, and
+# each account is in its own entity group.
+_XG = db.create_transaction_options(xg=True)
+
+
+class _PartnerChanged(Exception):
+    """Someone else linked or unlinked Alice since we loaded her account."""
+    pass
+
+
+class WaitingQueue(object):
+    """Memcached FIFO queue of the users who're waiting for a chat partner.
+
+    Rather than scan every started, available, unpartnered account in order to
+    find Alice a chat partner, we keep the key names of the users who're
+    waiting in a ring of memcached slots, addressed by a head counter and a
+    tail counter.  Pushing onto and popping off of the queue each cost a
+    constant number of memcache RPCs, no matter how many users are waiting.
+
+    The queue is only a hint.  A user who has since typed /stop, become
+    unavailable, or found a chat partner stays in his/her slot until someone
+    pops him/her, so whoever pops a user has to check his/her account.  And if
+    memcache evicts the head or tail counter, then we rebuild the queue from
+    the datastore.
+    """
+
+    _HEAD_KEY = WAITING_QUEUE_KEY + '_head'
+    _TAIL_KEY = WAITING_QUEUE_KEY + '_tail'
+    _LOCK_KEY = WAITING_QUEUE_KEY + '_lock'
+    _GENERATION_KEY = WAITING_QUEUE_KEY + '_generation'
+
+    @staticmethod
+    def _slot_key(index):
+        """Compute the memcache key for the slot at the given index."""
+        return WAITING_QUEUE_KEY + '_' + str(index)
+
+    @classmethod
+    def _rebuild_state(cls):
+        """Return whether the queue is being rebuilt, and its generation.
+
+        Every rebuild bumps the queue's generation.  So if the generation
+        changes while we're pushing onto the queue, then a rebuild might have
+        clobbered our push.
+        """
+        state = memcache.get_multi([cls._LOCK_KEY, cls._GENERATION_KEY])
+        return cls._LOCK_KEY in state, state.get(cls._GENERATION_KEY)
+
+    @classmethod
+    def push(cls, alice):
+        """Alice is waiting for a chat partner.  Put her at the back of the queue."""
+        cls._push(alice.key().name())
+
+    @classmethod
+    def _push(cls, key_name):
+        """Put the given key name at the back of the queue.
+
+        A push is two memcache RPCs (increment the tail, then fill the slot),
+        and a rebuild resets the head and the tail.  So we don't push while the
+        queue is being rebuilt, and if a rebuild starts while we're pushing,
+        then we push again once the rebuild is done.
+        """
+        locked, generation = cls._rebuild_state()
+        if locked:
+            cls._push_later(key_name)
+            return
+
+        index = memcache.incr(cls._TAIL_KEY)
+        if index is None:
+            _log.warning("couldn't push %s; waiting queue not memcached" %
+                         key_name)
+            key_names = cls.rebuild()
+            if key_names is None:
+                # Someone else is already rebuilding the queue.
+                cls._push_later(key_name)
+            elif key_name not in key_names:
+                # The rebuild's query didn't see Alice yet.
+                cls._push(key_name)
+            return
+
+        memcache.set(cls._slot_key(index), key_name)
+        if cls._rebuild_state() != (False, generation):
+            _log.info('waiting queue rebuilt while pushing %s' % key_name)
+            cls._push_later(key_name)
+            return
+        _log.debug('pushed %s onto waiting queue at %s' % (key_name, index))
+
+    @classmethod
+    def _push_later(cls, key_name):
+        """Push the given key name once the queue has been rebuilt."""
+        _log.info('deferring push of %s onto waiting queue' % key_name)
+        deferred.defer(cls._push_if_waiting, key_name,
+                       _countdown=WAITING_QUEUE_SLOT_TIMEOUT)
+
+    @classmethod
+    def _push_if_waiting(cls, key_name):
+        """Push the given key name, if that user is still waiting for a chat
+        partner."""
+        alice = models.Account.get_by_key_name(key_name)
+        if alice is not None and alice.started and alice.available and \
+           alice.partner_handle() is None:
+            cls._push(key_name)
+            cls._pair_later()
+
+    @staticmethod
+    def _pair_later():
+        """Schedule pairing up the users who're waiting on the queue.
+
+        Normally, a user waits on the queue until someone else looks for a
+        chat partner and pops him/her.  But while the queue can't be popped
+        (while it's being rebuilt, or while its head slot is still being pushed
+        onto), users who look for a partner get pushed instead, and two of them
+        would wait for each other until a third user came along.  So once the
+        queue can be popped again, pair them up (see
+        Strangers.pair_waiting).
+        """
+        coalescing.Coalescer.defer(WAITING_QUEUE_KEY + '_pair',
+                                   WAITING_QUEUE_SLOT_TIMEOUT,
+                                   Strangers.pair_waiting)
+
+    @classmethod
+    def pop(cls):
+        """Remove and return the key name at the front of the queue.
+
+        If the queue is empty, or if it's being rebuilt, this method returns
+        None.
+        """
+        client = memcache.Client()
+        for retry in range(NUM_RETRIES):
+            if cls._rebuild_state()[0]:
+                _log.info("couldn't pop; waiting queue being rebuilt")
+                cls._pair_later()
+                return None
+            head = client.gets(cls._HEAD_KEY)
+            tail = client.get(cls._TAIL_KEY)
+            if head is None or tail is None:
+                _log.warning("couldn't pop; waiting queue not memcached")
+                if cls.rebuild() is None:
+                    return None
+                continue
+            if head >= tail:
+                return None
+
+            index = head + 1
+            key_name = client.get(cls._slot_key(index))
+            if key_name is None and not cls._expired(index):
+                # Either someone is in the middle of pushing onto this slot, or
+                # memcache has evicted it.  Give the pusher a chance to finish
+                # before we skip the slot, and treat the queue as empty until
+                # then.
+                cls._pair_later()
+                return None
+            if client.cas(cls._HEAD_KEY, index):
+                if key_name is not None:
+                    _log.debug('popped %s off of waiting queue' % key_name)
+                    return key_name
+                _log.warning('skipped empty waiting queue slot %s' % index)
+
+    @classmethod
+    def _expired(cls, index):
+        """Return whether the slot at the given index has been empty for longer
+        than WAITING_QUEUE_SLOT_TIMEOUT seconds."""
+        key = cls._slot_key(index) + '_empty'
+        now = time.time()
+        memcache.add(key, now, time=WAITING_QUEUE_SLOT_TIMEOUT * 10)
+        empty_since = memcache.get(key)
+        return empty_since is not None and \
+               now - empty_since >= WAITING_QUEUE_SLOT_TIMEOUT
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild the queue from the datastore.
+
+        This is the only place where we query for all of the users who're
+        waiting for a chat partner.  Return the set of key names that we put in
+        the queue, or None if someone else is already rebuilding it.
+        """
+        if not memcache.add(cls._LOCK_KEY, True, time=60):
+            _log.info('not rebuilding waiting queue (already rebuilding)')
+            return None
+
+        _log.info('rebuilding waiting queue')
+        memcache.incr(cls._GENERATION_KEY, initial_value=0)
+        try:
+            carols = models.Account.get_users(started=True, available=True,
+                                              chatting=False, order=True)
+            key_names = set()
+            tail = 0
+            slots = {}
+            for carol in carols:
+                if carol.name() in key_names:
+                    continue
+                key_names.add(carol.name())
+                tail += 1
+                slots[cls._slot_key(tail)] = carol.name()
+                if len(slots) >= 500:
+                    memcache.set_multi(slots)
+                    slots = {}
+            slots[cls._HEAD_KEY] = 0
+            slots[cls._TAIL_KEY] = tail
+            memcache.set_multi(slots)
+        finally:
+            memcache.delete(cls._LOCK_KEY)
+        _log.info('rebuilt waiting queue with %s users' % tail)
+        cls._pair_later()
+        return key_names
+
+
+class Routes(object):
+    """Memcached map from each chatting user's handle to his/her partner's.
+
+    Relaying an IM is the single most common thing that we do, so we want to
+    do it without touching the datastore.  Whenever we link two chat partners,
+    we memcache each one's route to the other.  Whenever we unlink them, we
+    overwrite their routes with empty strings (rather than deleting them), so
+    that a request that read their accounts before they were unlinked can't
+    add the stale routes back.
+
+    Every route expires after ROUTES_TTL seconds, so even if we fail to clear
+    a route, it can't relay IMs to an ex-partner forever.
+    """
+
+    @staticmethod
+    def _key(handle):
+        """Compute the memcache key for the given IM handle address's route."""
+        return ROUTES_KEY + '_' + str(handle)
+
+    @classmethod
+    def get(cls, alice):
+        """Return Alice's partner's handle, or None if it's not memcached."""
+        bob = memcache.get(cls._key(alice))
+        return bob if bob else None
+
+    @classmethod
+    def add(cls, alice, bob):
+        """Memcache Alice's route to Bob, unless her route is already memcached."""
+        memcache.add(cls._key(alice), str(bob), time=ROUTES_TTL)
+
+    @classmethod
+    def link(cls, alice, bob):
+        """Alice and Bob are now chatting.  Memcache their routes."""
+        routes = {cls._key(alice): str(bob), cls._key(bob): str(alice)}
+        cls._set_multi(routes)
+
+    @classmethod
+    def unlink(cls, *accounts):
+        """These users are no longer chatting.  Clear their routes."""
+        routes = dict([(cls._key(account), '') for account in accounts])
+        cls._set_multi(routes)
+
+    @staticmethod
+    def _set_multi(routes):
+        """Memcache the given routes.
+
+        If we couldn't set a route, then whatever is memcached for it might be
+        stale, so delete it.  (Then the next IM will look up the route in the
+        datastore.)
+        """
+        failed = memcache.set_multi(routes, time=ROUTES_TTL)
+        if failed:
+            _log.warning("couldn't set routes %s; deleting them" % failed)
+            if memcache.delete_multi(failed) is not True:
+                _log.error("couldn't delete routes %s" % failed)
+
+    @classmethod
+    def reconcile(cls, cutoff=None, query=0, cursor=None, num_drifted=0):
+        """Correct memcached routes that have drifted from the datastore.
+
+        Only two kinds of users can have a memcached route: users who've typed
+        /start, and users whose accounts we've put within the last ROUTES_TTL
+        seconds (any older route has expired).  We check both, in batches of
+        RECONCILE_BATCH_SIZE users.  After RECONCILE_BATCHES batches (or if we
+        run out of time), we defer the rest, from where we left off.  Return
+        the number of routes (so far) that had drifted.
+        """
+        if cutoff is None:
+            cutoff = datetime.datetime.now() - \
+                     datetime.timedelta(seconds=ROUTES_TTL)
+        started = models.Account.get_users(started=True)
+        recent = models.Account.all(keys_only=True)
+        recent = recent.filter('datetime >=', cutoff)
+        queries = (started, recent)
+
+        keys = queries[query]
+        if cursor is not None:
+            keys = keys.with_cursor(cursor)
+        try:
+            for batch in range(RECONCILE_BATCHES):
+                chunk = keys.fetch(RECONCILE_BATCH_SIZE)
+                if not chunk:
+                    query, cursor = query + 1, None
+                    break
+                num_drifted += cls._reconcile_batch(chunk)
+                cursor = keys.cursor()
+                keys = keys.with_cursor(cursor)
+        except DeadlineExceededError:
+            _log.warning('deadline; deferring reconciling remaining routes')
+
+        if query < len(queries):
+            deferred.defer(cls.reconcile, cutoff=cutoff, query=query,
+                           cursor=cursor, num_drifted=num_drifted)
+        else:
+            _log.info('%s routes drifted' % num_drifted)
+        return num_drifted
+
+    @classmethod
+    def _reconcile_batch(cls, keys):
+        """Correct the drifted routes of the users with the given keys.
+
+        We read their memcached routes before we get their accounts, and only
+        correct a route if no one has updated it since we read it.  Return the
+        number of routes that had drifted.
+        """
+        client = memcache.Client()
+        num_drifted = 0
+        handles = [models.Account.key_to_handle(key.name()) for key in keys]
+        memcached = client.get_multi([cls._key(handle) for handle in handles],
+                                     for_cas=True)
+        for account in db.get(keys):
+            if account is None:
+                continue
+            key = cls._key(account)
+            route = account.partner_handle() or ''
+            if memcached.has_key(key) and memcached[key] != route:
+                num_drifted += 1
+                client.cas(key, route, time=ROUTES_TTL)
+        return num_drifted
+
 
 class Strangers(object):
     """ """
@@ -39,100 +376,246 @@ class Strangers(object):
     def _find_partner(alice):
         """Alice is looking to chat.  Find her a partner, Carol."""
         alice_key = alice.key()
-        carols = models.Account.get_users(keys_only=False, started=True,
-                                          available=True, chatting=False,
-                                          order=True)
-        for carol in carols:
+        carol, skipped = None, []
+        for retry in range(NUM_PARTNER_CANDIDATES):
+            key_name = WaitingQueue.pop()
+            if key_name is None:
+                break
+            if key_name == alice_key.name():
+                continue
+
+            # The waiting queue is only a hint.  Make sure that Carol is still
+            # looking for a chat partner.
+            candidate = models.Account.get_by_key_name(key_name)
+            if candidate is None or not candidate.started or \
+               not candidate.available or \
+               models.Account.partner.get_value_for_datastore(candidate):
+                continue
+
             # If Alice previously /nexted Carol this session, then Carol is in
             # Alice's blacklist.  However, if Carol previously /nexted Alice,
             # then Alice is in Carol's blacklist.  Make sure that neither is
             # the case.
-            carol_key = carol.key()
-            if alice_key not in carol.partners and \
-               carol_key not in alice.partners:
-
-                # TODO: Use Google App Engine's XMPP API to ensure that Carol's
-                # Google Talk status is available (and not idle or busy).
-                #
-                # Upon further research, I've discovered that it's currently
-                # impossible to detect a user's status.  All we can see is
-                # whether or not a user is online, but not if the user is
-                # available, idle, or away.  Universal sadness.  :-(  For more
-                # information, see:
-                #     http://code.google.com/p/googleappengine/issues/detail?id=2238#c6
-
-                # Hooray, we've found Alice a chat partner!
-                return carol
-
-        # Drat.  We couldn't find Alice a chat partner.  Either no one else is
-        # available for chat, or everyone else available for chat already has a
-        # partner.  Implicitly return None.
-
-    @classmethod
-    def _link_partners(cls, alice):
-        """Alice is looking to chat.  Find her a partner, and link them."""
-        carol = cls._find_partner(alice)
-        alice.partner = carol
-        if carol is not None:
-            carol.partner = alice
-        return alice, carol
+            carol_key = candidate.key()
+            if candidate.has_blacklisted(alice_key) or \
+               alice.has_blacklisted(carol_key):
+                skipped.append(candidate)
+                continue
+
+            # TODO: Use Google App Engine's XMPP API to ensure that Carol's
+            # Google Talk status is available (and not idle or busy).
+            #
+            # Upon further research, I've discovered that it's currently
+            # impossible to detect a user's status.  All we can see is
+            # whether or not a user is online, but not if the user is
+            # available, idle, or away.  Universal sadness.  :-(  For more
+            # information, see:
+            #     http://code.google.com/p/googleappengine/issues/detail?id=2238#c6
+
+            # Hooray, we've found Alice a chat partner!
+            carol = candidate
+            break
+
+        # Anyone that we skipped because of a blacklist is still waiting for a
+        # chat partner, so put him/her back on the waiting queue.
+        for candidate in skipped:
+            WaitingQueue.push(candidate)
+
+        # If carol is None, then drat.  We couldn't find Alice a chat partner.
+        # Either no one else is available for chat, or everyone else available
+        # for chat already has a partner.
+        return carol
 
     @staticmethod
-    def _unlink_partners(alice):
-        """Alice is not looking to chat.  Unlink her from her partner."""
-        bob = alice.partner
-        alice.partner = None
-        if bob is not None:
-            if bob.partner == alice:
-                bob.partner = None
-                alice.partners.append(bob.key())
+    def _refresh(alice_key, partner_key, update=None):
+        """Re-get Alice's account within a transaction, and apply the caller's
+        update to it.
+
+        The caller loaded Alice's account at the start of the request, and
+        someone else might have linked or unlinked her since.  Make sure that
+        her partner is still the one that the caller expects (partner_key), or
+        raise _PartnerChanged (which rolls back the transaction).
+        """
+        alice = models.Account.get(alice_key)
+        if alice is None or \
+           models.Account.partner.get_value_for_datastore(alice) != partner_key:
+            raise _PartnerChanged()
+        if update is not None:
+            update(alice)
+        return alice
+
+    @classmethod
+    def _link_partners(cls, alice, update=None, active_delta=0):
+        """Alice is looking to chat.  Find her a partner, and link them.
+
+        We link Alice and her partner, Carol, in a cross-group transaction, so
+        that either both of them point at each other or neither of them does.
+        Within the transaction, we re-get both accounts, and apply the caller's
+        update (if any) to Alice's.  If Alice has just become active
+        (active_delta), then count her in the same transaction that puts her
+        account.
+
+        We also apply the caller's update to the copy of Alice's account that
+        we search with, so that (for example) if the update clears her
+        blacklist, we don't skip partners she /nexted in a previous session.
+        """
+        alice_key = alice.key()
+        if update is not None:
+            update(alice)
+
+        def txn(carol_key):
+            alice = cls._refresh(alice_key, None, update=update)
+            carol = models.Account.get(carol_key)
+            if carol is None or not carol.started or not carol.available or \
+               models.Account.partner.get_value_for_datastore(carol):
+                # Someone else beat Alice to Carol.
+                return alice, None
+            alice.partner = carol
+            carol.partner = alice
+            db.put([alice, carol])
+            models.Account.count_active(active_delta)
+            return alice, carol
+
+        def put_txn():
+            alice = cls._refresh(alice_key, None, update=update)
+            db.put(alice)
+            models.Account.count_active(active_delta)
+            return alice
+
+        try:
+            for retry in range(NUM_RETRIES):
+                carol = cls._find_partner(alice)
+                if carol is None:
+                    break
+                try:
+                    fresh, linked = db.run_in_transaction_options(_XG, txn,
+                                                                  carol.key())
+                except:
+                    # We've popped Carol off of the waiting queue, but we
+                    # didn't link her, so put her back.
+                    WaitingQueue.push(carol)
+                    raise
+                if linked is not None:
+                    Routes.link(fresh, linked)
+                    return fresh, linked
+            alice = db.run_in_transaction(put_txn)
+        except _PartnerChanged:
+            # Someone else linked Alice while we were looking for a partner for
+            # her.  Whoever linked her has already notified her.
+            alice = models.Account.get(alice_key)
+            _log.info('%s was linked by someone else' % alice)
+        return alice, None
+
+    @classmethod
+    def _unlink_partners(cls, alice, update=None, active_delta=0):
+        """Alice is not looking to chat.  Unlink her from her partner.
+
+        We unlink Alice and her partner, Bob, in a cross-group transaction, so
+        that either both of them forget each other or neither of them does.
+        Within the transaction, we re-get both accounts, and apply the caller's
+        update (if any) to Alice's.  If Alice has just become inactive
+        (active_delta), then count her in the same transaction that puts her
+        account.
+        """
+        alice_key = alice.key()
+
+        def txn(bob_key):
+            alice = cls._refresh(alice_key, bob_key, update=update)
+            alice.partner = None
+            bob = None
+            if bob_key is not None:
+                bob = models.Account.get(bob_key)
+                if bob is not None and \
+                   models.Account.partner.get_value_for_datastore(bob) == \
+                   alice_key:
+                    bob.partner = None
+                    alice.add_to_blacklist(bob_key)
+                else:
+                    bob = None
+            accounts = [account for account in (alice, bob)
+                        if account is not None]
+            db.put(accounts)
+            models.Account.count_active(active_delta)
+            return alice, bob
+
+        for retry in range(NUM_RETRIES):
+            bob_key = models.Account.partner.get_value_for_datastore(alice)
+            try:
+                alice, bob = db.run_in_transaction_options(_XG, txn, bob_key)
+            except _PartnerChanged:
+                # Alice's partner changed since we loaded her account.  Reload
+                # her account, and unlink her from her new partner instead.
+                _log.info("%s's partner changed; retrying unlink" % alice)
+                alice = models.Account.get(alice_key)
+                if alice is None:
+                    return None, None
             else:
-                bob = None
-        return alice, bob
+                accounts = [account for account in (alice, bob)
+                            if account is not None]
+                Routes.unlink(*accounts)
+                return alice, bob
+
+        # Alice's partner kept changing out from under us.  Give up, rather
+        # than fail the request; Alice can try again.
+        _log.error("couldn't unlink %s after %s tries" % (alice, NUM_RETRIES))
+        return alice, None
 
     @classmethod
-    def _start_or_stop_chat(cls, alice, start):
-        """Alice is looking to either start or stop chatting."""
-        if start:
+    def pair_waiting(cls, window=None):
+        """Pair up users who're waiting on the queue for each other.
+
+        Pop a waiting user, Alice, and look for a partner for her the same way
+        that we would if she'd just typed /start.  Keep going until someone
+        can't find a partner (then put him/her back on the queue).
+        """
+        num_paired = 0
+        for retry in range(NUM_PARTNER_CANDIDATES):
+            key_name = WaitingQueue.pop()
+            if key_name is None:
+                break
+            alice = models.Account.get_by_key_name(key_name)
+            if alice is None or not alice.started or not alice.available or \
+               alice.partner_handle() is not None:
+                continue
             alice, carol = cls._link_partners(alice)
+            if carol is None:
+                if alice is not None and alice.partner_handle() is None:
+                    WaitingQueue.push(alice)
+                break
+            notifications.Notifications.chatting(alice)
+            notifications.Notifications.chatting(carol)
+            num_paired += 1
+        _log.info('paired up %s waiting users' % (2 * num_paired))
+
+    @classmethod
+    def _start_or_stop_chat(cls, alice, start, update=None, active_delta=0):
+        """Alice is looking to either start or stop chatting.
+
+        If given, update is a function that makes the caller's changes to
+        Alice's account.  We apply it to a fresh copy of her account, within
+        the transaction that links or unlinks her.
+        """
+        if start:
+            alice, carol = cls._link_partners(alice, update=update,
+                                              active_delta=active_delta)
+            if carol is None and alice is not None and \
+               alice.partner_handle() is None:
+                # Alice couldn't find a chat partner, so she has to wait for
+                # one.
+                WaitingQueue.push(alice)
         else:
-            alice, carol = cls._unlink_partners(alice)
-        accounts = [account for account in (alice, carol)
-                    if account is not None]
-        async = db.put_async(accounts)
-        return alice, carol, async
+            alice, carol = cls._unlink_partners(alice, update=update,
+                                                active_delta=active_delta)
+        return alice, carol
 
     @classmethod
-    def start_chat(cls, alice):
+    def start_chat(cls, alice, update=None, active_delta=0):
         """ """
-        return cls._start_or_stop_chat(alice, True)
+        return cls._start_or_stop_chat(alice, True, update=update,
+                                       active_delta=active_delta)
 
     @classmethod
-    def stop_chat(cls, alice):
+    def stop_chat(cls, alice, update=None, active_delta=0):
         """ """
-        return cls._start_or_stop_chat(alice, False)
-
-    @staticmethod
-    def is_deliverable(alice):
-        """Alice has typed an IM.  Determine if it can be delivered to Bob."""
-        bob = alice.partner
-        if bob is None:
-            # Oops.  Alice doesn't have a chat partner.
-            _log.warning('%s typed IM, but has no chat partner' % alice)
-            return False
-
-        bob_partner_key = models.Account.partner.get_value_for_datastore(bob)
-        alice_key = alice.key()
-        if bob_partner_key != alice_key:
-            # Oops.  Alice thinks that her chat partner is Bob, but Bob doesn't
-            # think that his chat partner is Alice.  This can happen because we
-            # don't link/unlink chat partners transactionally, so we have to
-            # check for this case every time anyone types a message.
-            body = "%s typed IM, but %s's partner is %s and %s's partner is %s"
-            _log.error(body % (alice, alice, bob, bob, bob.partner))
-            return False
-
-        # Nothing else can go wrong.  Alice's message must be deliverable to
-        # Bob.
-        _log.debug('%s typed IM, OK to deliver to %s' % (alice, bob))
-        return True
+        return cls._start_or_stop_chat(alice, False, update=update,
+                                       active_delta=active_delta)